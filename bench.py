@@ -0,0 +1,357 @@
+# Нагрузочные замеры бота без сети.
+#
+# Бот запускается против локальной заглушки Bot API (aiohttp), которая
+# записывает вызовы и умеет изображать задержку, 429 RetryAfter и ошибки 5xx.
+# Все файлы бота создаются во временной папке, рабочие данные не трогаются.
+#
+#   python bench.py                          # размеры 1000, 10000, 100000
+#   python bench.py --sizes 1000 5000 --json bench.json
+#   python bench.py --api-latency 0.05 --rate-limit 0.02 --error-rate 0.01
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from aiohttp import web
+
+BENCH_PORT = 18081
+
+
+class FakeBotAPI:
+    # Заглушка Bot API: отвечает на любой метод, считает вызовы
+
+    def __init__(self, latency=0.0, rate_limit=0.0, error_rate=0.0, retry_after=1):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.calls = []
+        self.delivered = 0
+        self.message_ids = itertools.count(1)
+        self.runner = None
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        data = await request.post()
+        self.calls.append((time.monotonic(), method, data.get("chat_id")))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        roll = random.random()
+        if roll < self.rate_limit:
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after}
+            }, status=429)
+        if roll < self.rate_limit + self.error_rate:
+            return web.json_response({"ok": False, "error_code": 500, "description": "Internal Server Error"}, status=500)
+
+        if not method.startswith("send"):
+            return web.json_response({"ok": True, "result": True})
+        self.delivered += 1
+        message = {"message_id": next(self.message_ids), "date": int(time.time()), "chat": {"id": 1, "type": "channel"}}
+        if method == "sendPhoto":
+            message["photo"] = [{"file_id": f"bench-{message['message_id']}", "file_unique_id": "u", "width": 1, "height": 1}]
+        if method == "sendMediaGroup":
+            message = [message]
+        return web.json_response({"ok": True, "result": message})
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def rss_mb():
+    # ru_maxrss в Linux — килобайты
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(results, name, size, fn):
+    tracemalloc.start()
+    started = time.perf_counter()
+    extra = fn()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    row = {"scenario": name, "size": size, "seconds": elapsed, "peak_mb": peak / 2 ** 20}
+    if isinstance(extra, dict):
+        row.update(extra)
+    results.append(row)
+    return row
+
+
+async def ameasure(results, name, size, coro_fn):
+    tracemalloc.start()
+    started = time.perf_counter()
+    extra = await coro_fn()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    row = {"scenario": name, "size": size, "seconds": elapsed, "peak_mb": peak / 2 ** 20}
+    if isinstance(extra, dict):
+        row.update(extra)
+    results.append(row)
+    return row
+
+
+def scheduled_post(i, when):
+    return {"id": f"bench{i:08d}", "datetime": when, "type": "text", "text": f"Пост для замера №{i} *жирный* текст"}
+
+
+def bench_schedule(bot, size, results):
+    # Загрузка расписания и стоимость тика, когда публиковать нечего
+    with open(bot.SCHEDULED_POSTS_FILE, "w", encoding="utf-8") as f:
+        json.dump([scheduled_post(i, f"2099-{i % 12 + 1:02d}-{i % 28 + 1:02d} {i % 24:02d}:{i % 60:02d}") for i in range(size)], f)
+    if os.path.exists(bot.SCHEDULED_JOURNAL_FILE):
+        os.remove(bot.SCHEDULED_JOURNAL_FILE)
+
+    store = bot.ScheduledPosts(bot.SCHEDULED_POSTS_FILE, bot.SCHEDULED_JOURNAL_FILE, bot.SCHEDULED_LOCK_FILE)
+    bot.schedule = store
+    # Загрузка вместе с построением индекса поиска, как при старте бота
+    bot.schedule_search = bot.ScheduleSearch()
+    store.listeners.append(bot.schedule_search.update)
+    measure(results, "schedule.load", size, store.load)
+    measure(results, "schedule search", size, lambda: bot.schedule_search.search(bot.search_query(f"№{size // 2}"), bot.PAGE_SIZE))
+
+    now = bot.datetime.now().strftime(bot.DATETIME_FORMAT)
+    ticks = []
+    for _ in range(1000):
+        started = time.perf_counter()
+        store.pop_due(now)
+        ticks.append(time.perf_counter() - started)
+    results.append({"scenario": "scheduler tick (idle)", "size": size,
+                    "seconds": statistics.median(ticks), "p95": percentile(ticks, 0.95)})
+
+    def edits():
+        for post_id in list(store.posts)[:200]:
+            store.reschedule(post_id, "2099-12-31 23:59")
+    measure(results, "schedule reschedule x200", size, edits)
+
+
+def bench_due_tick(bot, size, results):
+    # Худший тик: наступило время сразу для всего расписания
+    measure(results, "scheduler tick (all due)", size, lambda: {"popped": len(bot.schedule.pop_due("9999-12-31 23:59"))})
+
+
+async def bench_loop_stall(bot, size, results, edits=500):
+    # Насколько запись на диск задерживает event loop: во время серии правок
+    # расписания меряем, насколько позже срока просыпается sleep(1 мс)
+    lags = []
+    done = asyncio.Event()
+
+    async def probe():
+        loop = asyncio.get_running_loop()
+        while not done.is_set():
+            started = loop.time()
+            await asyncio.sleep(0.001)
+            lags.append(max(0.0, loop.time() - started - 0.001))
+
+    task = asyncio.create_task(probe())
+    await asyncio.sleep(0.01)
+    started = time.perf_counter()
+    for post_id in list(bot.schedule.posts)[:edits]:
+        bot.schedule.reschedule(post_id, "2099-12-30 12:00")
+        await asyncio.sleep(0)
+    await bot.schedule.flush()
+    elapsed = time.perf_counter() - started
+    done.set()
+    await task
+    results.append({"scenario": f"loop lag during {edits} edits", "size": size, "seconds": statistics.median(lags),
+                    "p95": percentile(lags, 0.95), "max_lag": max(lags), "edits_sec": elapsed})
+
+
+def bench_library(bot, size, results):
+    store = bot.PostStore(f"posts_{size}.db")
+    store.open()
+
+    def fill():
+        now = bot.datetime.now().isoformat(timespec="seconds")
+        with store.db:
+            store.db.executemany(
+                "INSERT INTO posts (text, created_at, updated_at) VALUES (?, ?, ?)",
+                ((f"Пост библиотеки №{i}\nвторая строка", now, now) for i in range(size))
+            )
+    measure(results, "library fill", size, fill)
+
+    ids = [random.randint(1, size) for _ in range(1000)]
+    for name, op in [
+        ("library count", lambda: store.count()),
+        ("library get", lambda: [store.get(i) for i in ids]),
+        ("library page (last)", lambda: store.page(before_id=size + 1)),
+        ("library update", lambda: [store.update(i, "обновлён") for i in ids[:100]]),
+        ("library search (rare word)", lambda: store.search(bot.search_query(f"№{size // 2}"), bot.PAGE_SIZE)),
+        ("library search (every post)", lambda: store.search(bot.search_query("библиотеки"), bot.PAGE_SIZE)),
+    ]:
+        measure(results, name, size, op)
+    # Дальше хендлеры библиотеки работают с этой базой
+    bot.post_store = store
+
+
+async def bench_dispatch(bot, size, results, updates=300):
+    # Задержка обработки апдейта целиком: фильтры, хендлер, ответ в API
+    from aiogram import types
+
+    def message(text, n):
+        return types.Update(update_id=n, message={
+            "message_id": n, "date": int(time.time()), "text": text,
+            "chat": {"id": bot.ADMIN_ID, "type": "private"},
+            "from": {"id": bot.ADMIN_ID, "is_bot": False, "first_name": "bench"}
+        })
+
+    for text in ("📊 Статистика", "📅 Расписание", "📋 Список постов"):
+        latencies = []
+        for n in range(updates):
+            started = time.perf_counter()
+            await asyncio.create_task(bot.dp.process_update(message(text, n)))
+            latencies.append(time.perf_counter() - started)
+        results.append({"scenario": f"dispatch {text}", "size": size,
+                        "seconds": statistics.median(latencies), "p95": percentile(latencies, 0.95)})
+
+
+async def bench_publish(bot, api, results, posts, chats):
+    # Пропускная способность публикатора с настоящими лимитами Telegram
+    bot.publisher = publisher = bot.Publisher("bench_dead_letters.json", bot.schedule)
+    publisher.start()
+    api.calls.clear()
+    delivered_before = api.delivered
+
+    async def run():
+        for i in range(posts):
+            post = scheduled_post(i, bot.datetime.now().strftime(bot.DATETIME_FORMAT))
+            post["id"] = f"publish{i:08d}"  # не из outbox: иначе результаты запишутся в посты расписания
+            publisher.submit(-1000 - i % chats, post)
+        # Повторы после ошибок возвращаются в очередь с задержкой, поэтому
+        # ждём не пустую очередь, а пока каждый пост не дойдёт или не упадёт
+        while api.delivered - delivered_before + len(publisher.dead_letters) < posts:
+            await asyncio.sleep(0.01)
+        return {}
+
+    row = await ameasure(results, f"publish {posts} posts / {chats} chats", posts, run)
+    sent = posts - len(publisher.dead_letters)
+    row["per_sec"] = sent / row["seconds"]
+    row["api_calls"] = len(api.calls)
+    row["dead_letters"] = len(publisher.dead_letters)
+    await publisher.stop()
+
+
+async def bench_fanout(bot, api, results, posts, channels):
+    # Один и тот же пост в несколько каналов: каналы отправляются параллельно,
+    # поэтому время должно расти заметно медленнее числа каналов
+    bot.publisher = publisher = bot.Publisher("bench_dead_letters.json", bot.schedule)
+    publisher.start()
+    delivered_before = api.delivered
+    targets = [str(-2000 - i) for i in range(channels)]
+
+    async def run():
+        for i in range(posts):
+            post = scheduled_post(i, bot.datetime.now().strftime(bot.DATETIME_FORMAT))
+            post.update(id=f"fanout{channels}-{i}", targets=targets)
+            publisher.publish(post)
+        while api.delivered - delivered_before + len(publisher.dead_letters) < posts * channels:
+            await asyncio.sleep(0.01)
+        return {}
+
+    await ameasure(results, f"fan-out {posts} posts → {channels} channels", posts * channels, run)
+    await publisher.stop()
+
+
+def print_results(results):
+    print(f"{'сценарий':<40} {'размер':>8} {'время, с':>12} {'p95, с':>12} {'пик, МБ':>9}  прочее")
+    for row in results:
+        extra = {k: v for k, v in row.items() if k not in ("scenario", "size", "seconds", "p95", "peak_mb")}
+        extra = ", ".join(f"{k}={v:.4g}" if isinstance(v, float) else f"{k}={v}" for k, v in extra.items())
+        print(f"{row['scenario']:<40} {row['size']:>8} {row['seconds']:>12.3g} "
+              f"{row.get('p95', 0):>12.3g} {row.get('peak_mb', 0):>9.2f}  {extra}")
+    print(f"\nМаксимальный RSS процесса: {rss_mb():.1f} МБ")
+
+
+async def main(args):
+    workdir = tempfile.mkdtemp(prefix="vibey-bench-")
+    os.chdir(workdir)
+    os.environ.setdefault("BOT_TOKEN", "123456:bench")
+    os.environ["BOT_API_SERVER"] = f"http://127.0.0.1:{args.port}"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import logging
+    import bot
+    from aiogram import Bot, Dispatcher
+    logging.getLogger().setLevel(logging.WARNING)
+
+    # Ошибки включаются только для публикатора: хендлеры админа их не повторяют
+    api = FakeBotAPI(args.api_latency)
+    await api.start(args.port)
+    Bot.set_current(bot.bot)
+    Dispatcher.set_current(bot.dp)
+    # Шаги диалогов хендлеры хранят в posts.db рабочей папки
+    bot.fsm_storage.open()
+    bot.PUBLISH_BACKOFF_BASE = 0.05
+
+    results = []
+    try:
+        for size in args.sizes:
+            bench_schedule(bot, size, results)
+            bot.schedule_previews = bot.PreviewIndex()
+            bot.schedule.listeners.append(bot.schedule_previews.update)
+            for post_id, post in bot.schedule.posts.items():
+                bot.schedule_previews.update(post_id, post)
+            await bench_loop_stall(bot, size, results)
+            bench_library(bot, size, results)
+            await bench_dispatch(bot, size, results, args.updates)
+            bench_due_tick(bot, size, results)
+            # Отложенные записи этого размера не должны попасть в файлы следующего
+            await bot.schedule.flush()
+        api.rate_limit, api.error_rate = args.rate_limit, args.error_rate
+        await bench_publish(bot, api, results, args.publish_posts, args.publish_chats)
+        for channels in (1, 5, 20):
+            await bench_fanout(bot, api, results, bot.CHAT_SEND_BURST, channels)
+    finally:
+        await bot.close_http_session()
+        session = await bot.bot.get_session()
+        await session.close()
+        await api.stop()
+
+    print(f"Рабочая папка: {workdir}\n")
+    print_results(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Замеры бота против локальной заглушки Bot API")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--updates", type=int, default=300, help="апдейтов на сценарий диспетчеризации")
+    parser.add_argument("--publish-posts", type=int, default=300)
+    parser.add_argument("--publish-chats", type=int, default=100)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа заглушки, с")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--port", type=int, default=BENCH_PORT)
+    parser.add_argument("--json", help="сохранить результаты в JSON для сравнения между версиями")
+    args = parser.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    asyncio.run(main(args))
@@ -6,34 +6,495 @@ from aiogram.types import ParseMode, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.utils import executor
 from aiogram.types import ContentType, InputMediaPhoto
 import os
+import sys
+import csv
 import json
-from datetime import datetime
+import sqlite3
+import socket
+import fcntl
+import io
+import itertools
+from datetime import datetime, timedelta
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import aiohttp
+from aiohttp import web
 import tempfile
+import heapq
+import uuid
+import hashlib
+import hmac
+import re
+import bisect
+from collections import OrderedDict, deque, defaultdict
+from contextlib import contextmanager
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
 from aiogram.types import InputFile
+from aiogram.dispatcher.storage import BaseStorage
+from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.exceptions import RetryAfter, BadRequest, Unauthorized, NotFound, MessageNotModified, TelegramAPIError
+from aiogram.dispatcher.handler import current_handler
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 
 API_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = 490364050
 CHANNEL_ID = os.getenv("CHANNEL_ID", "@vibeytravelers")
+# Каналы, куда по умолчанию уходит каждый пост, через запятую (например, языковые версии)
+CHANNEL_IDS = [c.strip() for c in os.getenv("CHANNEL_IDS", CHANNEL_ID).split(",") if c.strip()]
+STAGING_CHAT_ID = os.getenv("STAGING_CHAT_ID", ADMIN_ID)  # куда загружаем медиа заранее
 
 logging.basicConfig(level=logging.INFO)
-bot = Bot(token=API_TOKEN)
-dp = Dispatcher(bot)
 
-POSTS_FILE = "posts.txt"
-
-def load_posts():
+# ===== Метрики (Prometheus, отдаются на /metrics) =====
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PUBLISH_LAG = Histogram("publish_lag_seconds", "Фактическое время отправки минус время поста по расписанию",
+                        buckets=(1, 5, 15, 30, 60, 120, 300, 900, 3600, 21600))
+TICK_DURATION = Histogram("scheduler_tick_seconds", "Длительность check_scheduled_posts", buckets=LATENCY_BUCKETS)
+HANDLER_LATENCY = Histogram("handler_latency_seconds", "Время обработки апдейта хендлером", ["handler"], buckets=LATENCY_BUCKETS)
+API_LATENCY = Histogram("telegram_api_latency_seconds", "Длительность вызовов Bot API", ["method"], buckets=LATENCY_BUCKETS)
+POSTS_SENT = Counter("posts_sent_total", "Попытки публикации по типу поста и результату", ["type", "outcome"])
+LOOP_LAG = Histogram("event_loop_lag_seconds", "Насколько позже срока просыпается event loop",
+                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+STORAGE_IO = Histogram("storage_io_seconds", "Операции с диском в потоке хранилища", ["op"], buckets=LATENCY_BUCKETS)
+
+class InstrumentedBot(Bot):
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.monotonic()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        finally:
+            API_LATENCY.labels(method).observe(time.monotonic() - started)
+
+# Свой сервер Bot API (локальный telegram-bot-api или заглушка из bench.py)
+BOT_API_SERVER = os.getenv("BOT_API_SERVER")
+bot = InstrumentedBot(token=API_TOKEN, server=TelegramAPIServer.from_base(BOT_API_SERVER) if BOT_API_SERVER else TELEGRAM_PRODUCTION)
+
+# ===== Запись на диск вне event loop =====
+# fsync, os.replace и запись файлов идут в отдельном потоке, чтобы не
+# задерживать апдейты. Поток один: записи попадают на диск в том порядке,
+# в каком поставлены в очередь. Без запущенного event loop (CLI, замеры)
+# всё пишется сразу.
+WRITE_BEHIND_DELAY = 0.05  # секунды, за которые изменения сливаются в одну запись
+storage_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+
+def running_loop():
     try:
-        with open(POSTS_FILE, "r", encoding="utf-8") as f:
-            posts = f.read().split("---")
-            return [p.strip() for p in posts if p.strip()]
-    except:
-        return []
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
 
-def save_posts(posts):
-    with open(POSTS_FILE, "w", encoding="utf-8") as f:
-        f.write("\n---\n".join(posts))
+async def run_io(op, fn, *args):
+    def timed():
+        with STORAGE_IO.labels(op).time():
+            return fn(*args)
+    return await asyncio.get_running_loop().run_in_executor(storage_executor, timed)
+
+def write_file_atomic(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class WriteBehindFile:
+    # Файл, который перезаписывается целиком (неотправленные, кэш медиа).
+    # mark_dirty() только откладывает запись: серия изменений за
+    # WRITE_BEHIND_DELAY превращается в одну запись актуального содержимого.
+
+    def __init__(self, path, serialize, delay=WRITE_BEHIND_DELAY):
+        self.path = path
+        self.serialize = serialize  # () → bytes, вызывается в event loop в момент записи
+        self.delay = delay
+        self.timer = None
+
+    def mark_dirty(self):
+        loop = running_loop()
+        if loop is None:
+            write_file_atomic(self.path, self.serialize())
+        elif self.timer is None:
+            self.timer = loop.create_task(self._write_later())
+
+    async def _write_later(self):
+        await asyncio.sleep(self.delay)
+        # Изменения после этой строки запланируют следующую запись
+        self.timer = None
+        await run_io(os.path.basename(self.path), write_file_atomic, self.path, self.serialize())
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+            await run_io(os.path.basename(self.path), write_file_atomic, self.path, self.serialize())
+
+POSTS_FILE = "posts.txt"  # старый формат, переносится в базу один раз
+POSTS_DB_FILE = "posts.db"
+# Без учёта регистра и диакритики латиницы («é» ищется как «e»). «ё»
+# unicode61 не трогает — её заменяем на «е» сами, в индексе и в запросе.
+SEARCH_TOKENIZER = "unicode61 remove_diacritics 2"
+SEARCH_CANDIDATES = 1000  # сколько самых новых совпадений ранжировать (PostStore.search)
+
+class PostStore:
+    # Библиотека постов в SQLite. Номер поста — это его id: номера не
+    # сдвигаются после удаления, а поиск по номеру идёт по первичному ключу.
+    # Количество постов хранится в meta и поддерживается триггерами.
+    # Ими же обновляется полнотекстовый индекс posts_fts (текст и дата).
+
+    # Строка индекса: id, текст с «е» вместо «ё» и дата в двух видах —
+    # «2025-04-15 18:30» и «15.04.2025»
+    SEARCH_ROW = (
+        "id, replace(replace(text, 'ё', 'е'), 'Ё', 'Е'), "
+        "replace(substr(created_at, 1, 16), 'T', ' ') || ' ' || strftime('%d.%m.%Y', created_at)"
+    )
+
+    SCHEMA = f"""
+        CREATE TABLE IF NOT EXISTS posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS posts_updated_at ON posts(updated_at);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+        INSERT OR IGNORE INTO meta (key, value) VALUES ('post_count', 0);
+        CREATE TRIGGER IF NOT EXISTS posts_count_ins AFTER INSERT ON posts BEGIN
+            UPDATE meta SET value = value + 1 WHERE key = 'post_count';
+        END;
+        CREATE TRIGGER IF NOT EXISTS posts_count_del AFTER DELETE ON posts BEGIN
+            UPDATE meta SET value = value - 1 WHERE key = 'post_count';
+        END;
+        CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(text, date, tokenize = '{SEARCH_TOKENIZER}');
+        CREATE TRIGGER IF NOT EXISTS posts_fts_ins AFTER INSERT ON posts BEGIN
+            INSERT INTO posts_fts (rowid, text, date) SELECT {SEARCH_ROW} FROM posts WHERE id = new.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS posts_fts_upd AFTER UPDATE OF text ON posts BEGIN
+            DELETE FROM posts_fts WHERE rowid = new.id;
+            INSERT INTO posts_fts (rowid, text, date) SELECT {SEARCH_ROW} FROM posts WHERE id = new.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS posts_fts_del AFTER DELETE ON posts BEGIN
+            DELETE FROM posts_fts WHERE rowid = old.id;
+        END;
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+
+    def open(self):
+        self.db = sqlite3.connect(self.path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # В режиме WAL коммит без fsync не теряет данные при падении процесса,
+        # только при отключении питания; зато запись не ждёт диск в event loop
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.executescript(self.SCHEMA)
+        if not self.db.execute("SELECT 1 FROM meta WHERE key = 'posts_fts_built'").fetchone():
+            # База из версии без поиска: индексируем то, что уже есть
+            with self.db:
+                self.db.execute("DELETE FROM posts_fts")
+                self.db.execute(f"INSERT INTO posts_fts (rowid, text, date) SELECT {self.SEARCH_ROW} FROM posts")
+                self.db.execute("INSERT INTO meta (key, value) VALUES ('posts_fts_built', ?)", (datetime.now().isoformat(timespec="seconds"),))
+
+    def migrate_from_txt(self, txt_path):
+        if self.db.execute("SELECT 1 FROM meta WHERE key = 'posts_txt_migrated'").fetchone():
+            return
+        try:
+            with open(txt_path, "r", encoding="utf-8") as f:
+                texts = [p.strip() for p in f.read().split("---") if p.strip()]
+        except FileNotFoundError:
+            texts = []
+        now = datetime.now().isoformat(timespec="seconds")
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO posts (text, created_at, updated_at) VALUES (?, ?, ?)",
+                [(text, now, now) for text in texts]
+            )
+            self.db.execute("INSERT INTO meta (key, value) VALUES ('posts_txt_migrated', ?)", (now,))
+        logging.info(f"[POSTS MIGRATED] {len(texts)} постов перенесено из {txt_path}")
+
+    def read_only(self):
+        # Отдельное соединение для чтения из другого потока (выгрузка):
+        # в WAL оно видит снимок базы и не мешает записи
+        db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def count(self):
+        return self.db.execute("SELECT value FROM meta WHERE key = 'post_count'").fetchone()[0]
+
+    def get(self, post_id):
+        return self.db.execute("SELECT * FROM posts WHERE id = ?", (post_id,)).fetchone()
+
+    def all(self):
+        return self.db.execute("SELECT * FROM posts ORDER BY id")
+
+    def page(self, after_id=0, before_id=None, limit=10, width=100):
+        # Keyset-пагинация по id: стоимость не зависит от номера страницы
+        if before_id is not None:
+            rows = self.db.execute(
+                "SELECT id, substr(text, 1, ?) AS preview FROM posts WHERE id < ? ORDER BY id DESC LIMIT ?",
+                (width, before_id, limit)
+            ).fetchall()
+            return rows[::-1]
+        return self.db.execute(
+            "SELECT id, substr(text, 1, ?) AS preview FROM posts WHERE id > ? ORDER BY id LIMIT ?",
+            (width, after_id, limit)
+        ).fetchall()
+
+    def search(self, match, limit, width=100):
+        # match — выражение FTS5 из search_query(); лучшие совпадения первыми.
+        # Ранжируются SEARCH_CANDIDATES самых новых совпадений: слово, которое
+        # есть почти в каждом посте, иначе стоило бы bm25 по всей библиотеке.
+        return self.db.execute(
+            "SELECT p.id, substr(p.text, 1, ?) AS preview, hits.rank FROM ("
+            "    SELECT rowid, rank FROM posts_fts WHERE posts_fts MATCH ? ORDER BY rowid DESC LIMIT ?"
+            ") AS hits JOIN posts p ON p.id = hits.rowid ORDER BY hits.rank LIMIT ?",
+            (width, match, SEARCH_CANDIDATES, limit)
+        ).fetchall()
+
+    def has_before(self, post_id):
+        return self.db.execute("SELECT 1 FROM posts WHERE id < ? LIMIT 1", (post_id,)).fetchone() is not None
+
+    def has_after(self, post_id):
+        return self.db.execute("SELECT 1 FROM posts WHERE id > ? LIMIT 1", (post_id,)).fetchone() is not None
+
+    def add(self, text):
+        now = datetime.now().isoformat(timespec="seconds")
+        with self.db:
+            cur = self.db.execute(
+                "INSERT INTO posts (text, created_at, updated_at) VALUES (?, ?, ?)",
+                (text, now, now)
+            )
+        return cur.lastrowid
+
+    def add_many(self, posts):
+        # Одна транзакция на пачку. posts — пары (id или None, текст):
+        # пост с существующим id обновляется, без id — добавляется
+        now = datetime.now().isoformat(timespec="seconds")
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO posts (id, text, created_at, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET text = excluded.text, updated_at = excluded.updated_at",
+                [(post_id, text, now, now) for post_id, text in posts]
+            )
+
+    def update(self, post_id, text):
+        now = datetime.now().isoformat(timespec="seconds")
+        with self.db:
+            cur = self.db.execute(
+                "UPDATE posts SET text = ?, updated_at = ? WHERE id = ?",
+                (text, now, post_id)
+            )
+        return cur.rowcount > 0
+
+    def delete(self, post_id):
+        with self.db:
+            row = self.get(post_id)
+            if row is not None:
+                self.db.execute("DELETE FROM posts WHERE id = ?", (post_id,))
+        return row
+
+post_store = PostStore(POSTS_DB_FILE)
+
+# === Аренда роли ведущего ===
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", 6))  # секунды; за столько роль переходит к другой копии
+LEADER_LEASE_RENEW = LEADER_LEASE_TTL / 3
+REPLICA_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+class LeaderLease:
+    # Строка в SQLite: какая копия бота ведущая и до какого времени.
+    # Ведущая продлевает аренду каждые LEADER_LEASE_RENEW секунд; если она
+    # упала или зависла, после expires_at аренду забирает другая. Время —
+    # time.time(), поэтому копии должны работать на одном хосте.
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path, name, holder, ttl):
+        self.path = path
+        self.name = name
+        self.holder = holder
+        self.ttl = ttl
+        self.db = None
+        self.valid_until = 0.0  # time.monotonic(), до которого аренда точно наша
+
+    def open(self):
+        # Отдельное соединение: аренда продлевается из потока хранилища
+        self.db = sqlite3.connect(self.path, timeout=1, isolation_level=None, check_same_thread=False)
+        self.db.executescript(self.SCHEMA)
+
+    def acquire(self):
+        # Берёт свободную или истёкшую аренду либо продлевает свою
+        started = time.monotonic()
+        now = time.time()
+        cur = self.db.execute(
+            "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+            "WHERE leases.holder = excluded.holder OR leases.expires_at < ?",
+            (self.name, self.holder, now + self.ttl, now)
+        )
+        # Срок считаем от момента до запроса — у нас он кончится раньше, чем в базе
+        self.valid_until = started + self.ttl if cur.rowcount > 0 else 0.0
+        return cur.rowcount > 0
+
+    def release(self):
+        if self.db is None:
+            return
+        self.valid_until = 0.0
+        self.db.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (self.name, self.holder))
+
+    def is_leader(self):
+        # Без open() (CLI, замеры) процесс считает себя единственным
+        return self.db is None or time.monotonic() < self.valid_until
+
+leader_lease = LeaderLease(POSTS_DB_FILE, "publisher", REPLICA_ID, LEADER_LEASE_TTL)
+
+# === Общее состояние диалогов ===
+class SQLiteStorage(BaseStorage):
+    # Шаги сценариев (FSM) и предпросмотры постов в posts.db, а не в памяти:
+    # балансировщик может отдать следующий апдейт диалога другой копии бота.
+    # touched_at — время последнего апдейта пользователя, по нему
+    # expire_idle_states сбрасывает брошенные сценарии.
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS fsm (
+            chat_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            touched_at REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS previews (
+            user_id INTEGER PRIMARY KEY,
+            post TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+
+    def open(self):
+        # Запросы идут в потоке storage_executor (run_io), чтобы ожидание
+        # блокировки записи от другой копии не останавливало цикл событий.
+        # previews()/preview_count() читают из цикла: в WAL чтение не ждёт писателя.
+        self.db = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.executescript(self.SCHEMA)
+
+    async def close(self):
+        if self.db is not None:
+            await run_io("fsm", self.db.close)
+            self.db = None
+
+    async def wait_closed(self):
+        pass
+
+    def _address(self, chat, user):
+        return tuple(map(str, self.check_address(chat=chat, user=user)))
+
+    def _row(self, address):
+        return self.db.execute(
+            "SELECT state, data FROM fsm WHERE chat_id = ? AND user_id = ?", address
+        ).fetchone()
+
+    def _set(self, address, column, value):
+        with self.db:
+            self.db.execute(
+                f"INSERT INTO fsm (chat_id, user_id, {column}) VALUES (?, ?, ?) "
+                f"ON CONFLICT(chat_id, user_id) DO UPDATE SET {column} = excluded.{column}",
+                (*address, value)
+            )
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        row = await run_io("fsm", self._row, self._address(chat, user))
+        return row[0] if row is not None and row[0] is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        row = await run_io("fsm", self._row, self._address(chat, user))
+        return json.loads(row[1]) if row is not None else dict(default or {})
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        await run_io("fsm", self._set, self._address(chat, user), "state", self.resolve_state(state))
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        await run_io("fsm", self._set, self._address(chat, user), "data", json.dumps(data or {}, ensure_ascii=False))
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        current = await self.get_data(chat=chat, user=user)
+        current.update(data or {}, **kwargs)
+        await self.set_data(chat=chat, user=user, data=current)
+
+    async def touch(self, chat, user):
+        await run_io("fsm", self._set, self._address(chat, user), "touched_at", time.time())
+
+    def _expire(self, deadline):
+        with self.db:
+            rows = self.db.execute(
+                "DELETE FROM fsm WHERE touched_at < ? RETURNING chat_id, user_id, state", (deadline,)
+            ).fetchall()
+            expired = []
+            for chat_id, user_id, state in rows:
+                dropped = self.db.execute("DELETE FROM previews WHERE user_id = ?", (int(user_id),)).rowcount
+                expired.append((int(chat_id), state is not None or dropped > 0))
+        return expired
+
+    async def expire(self, deadline):
+        # Убирает пользователей без апдейтов с deadline вместе с их
+        # предпросмотрами. Возвращает (chat_id, был ли незаконченный сценарий)
+        return await run_io("fsm", self._expire, deadline)
+
+    def _set_preview(self, user_id, post):
+        with self.db:
+            self.db.execute(
+                "INSERT INTO previews (user_id, post) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET post = excluded.post",
+                (user_id, post)
+            )
+
+    def _get_preview(self, user_id):
+        return self.db.execute("SELECT post FROM previews WHERE user_id = ?", (user_id,)).fetchone()
+
+    def _pop_preview(self, user_id):
+        with self.db:
+            return self.db.execute("DELETE FROM previews WHERE user_id = ? RETURNING post", (user_id,)).fetchall()
+
+    async def set_preview(self, user_id, post):
+        await run_io("fsm", self._set_preview, user_id, json.dumps(post, ensure_ascii=False))
+
+    async def get_preview(self, user_id):
+        row = await run_io("fsm", self._get_preview, user_id)
+        return json.loads(row[0]) if row is not None else None
+
+    async def pop_preview(self, user_id):
+        rows = await run_io("fsm", self._pop_preview, user_id)
+        return json.loads(rows[0][0]) if rows else None
+
+    def previews(self):
+        if self.db is None:
+            return []
+        return [json.loads(post) for post, in self.db.execute("SELECT post FROM previews")]
+
+    def preview_count(self):
+        if self.db is None:
+            return 0
+        return self.db.execute("SELECT count(*) FROM previews").fetchone()[0]
+
+fsm_storage = SQLiteStorage(POSTS_DB_FILE)
+dp = Dispatcher(bot, storage=fsm_storage)
 
 # Клавиатура меню
 main_kb = ReplyKeyboardMarkup(resize_keyboard=True)
@@ -53,67 +514,2152 @@ main_kb.add(
     KeyboardButton("✏️ Редактировать запланированный"),
     KeyboardButton("📆 Изменить дату поста")
 )
+main_kb.add(
+    KeyboardButton("☠️ Неотправленные"),
+    KeyboardButton("📥 Импорт"),
+    KeyboardButton("📤 Экспорт"),
+    KeyboardButton("🔍 Поиск")
+)
 
 SCHEDULED_POSTS_FILE = "scheduled_posts.json"
+SCHEDULED_JOURNAL_FILE = "scheduled_posts.journal"
+SCHEDULED_LOCK_FILE = "scheduled_posts.lock"
+JOURNAL_COMPACT_EVERY = 200  # записей журнала до сжатия в снимок
+OUTBOX_HISTORY = 1000        # сколько последних результатов отправки помнить для идемпотентности
+DATETIME_FORMAT = "%Y-%m-%d %H:%M"
+SCHEDULER_TICK_SECONDS = 5
 scheduler = AsyncIOScheduler()
-pending_posts = {}  # временное хранилище предпросмотров
 
-def load_scheduled_posts():
-    try:
-        with open(SCHEDULED_POSTS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except:
+class ScheduledPosts:
+    # Запланированные посты в памяти + min-куча (datetime, id).
+    # Строки "ГГГГ-ММ-ДД ЧЧ:ММ" сортируются так же, как даты, поэтому
+    # ключом кучи служит сама строка. Устаревшие записи кучи (после
+    # удаления или смены даты) пропускаются при извлечении.
+    #
+    # На диске: снимок (JSON-список) + журнал изменений (JSON по строке).
+    # Каждое изменение дописывается в журнал, периодически журнал
+    # сворачивается в новый снимок через атомарный os.replace. Записи
+    # копятся в памяти и уходят на диск одной пачкой из потока хранилища;
+    # flush() дожидается, пока всё записанное до него окажется на диске.
+    #
+    # Тот же журнал служит исходящей очередью (outbox). Пост проходит
+    # состояния scheduled → sending → sent/failed, ключ идемпотентности —
+    # id поста и канал. Пост уходит из расписания в outbox до отправки и
+    # остаётся там, пока не записан результат по каждому из его каналов
+    # (results), так что падение в любой момент не теряет пост. Канал
+    # попадает в in_flight прямо перед запросом к Telegram: только такие
+    # отправки после падения могли уйти дважды.
+    #
+    # Журнал общий для всех копий бота: каждая помечает свои записи (by) и
+    # в sync() дочитывает чужие. Запись и сжатие идут под flock, а снимок
+    # пишет только та копия, что прочитала журнал до конца, — иначе чужие
+    # записи пропали бы при очистке журнала.
+
+    def __init__(self, path, journal_path, lock_path):
+        self.path = path
+        self.journal_path = journal_path
+        self.lock_path = lock_path
+        self.posts = {}
+        self.outbox = {}                 # id → пост в состоянии sending
+        self.finished = OrderedDict()    # id → {"id", "status", "results", "finished_at"} последних отправок
+        self.heap = []
+        self.journal_records = 0
+        self.pending_lines = []      # записи журнала, ещё не отданные на диск
+        self.compact_pending = False
+        self.flush_timer = None
+        self.writing_lines = []      # пачки, отданные в поток, но ещё не записанные
+        self.journal_offset = 0      # до какого байта журнал прочитан или записан нами
+        self.snapshot_stamp = None   # (inode, mtime) прочитанного снимка
+        self.listeners = []  # вызываются как listener(post_id, post или None)
+        self.rebuilders = {}  # listener → rebuild(posts): при перечитывании всего расписания вместо поштучных вызовов
+
+    def load(self):
+        self._reset(*self._read_state())
+        self.compact()
+
+    def _reset(self, snapshot, records):
+        old_ids = set(self.posts)
+        self.posts = {}
+        self.outbox = {}
+        self.finished = OrderedDict()
+        for post in snapshot:
+            if "id" not in post:
+                post["id"] = uuid.uuid4().hex
+            status = post.get("status", "scheduled")
+            if status == "scheduled":
+                self.posts[post["id"]] = post
+            elif status == "sending":
+                self.outbox[post["id"]] = post
+            else:
+                self.finished[post["id"]] = post
+        for record in records:
+            self._apply(record)
+        self.journal_records = len(records)
+        self._rebuild_heap()
+        for listener in self.listeners:
+            if listener in self.rebuilders:
+                self.rebuilders[listener](self.posts)
+                continue
+            for post_id in old_ids - set(self.posts):
+                listener(post_id, None)
+            for post_id, post in self.posts.items():
+                listener(post_id, post)
+
+    def _notify(self, post_id, post):
+        for listener in self.listeners:
+            listener(post_id, post)
+
+    def _read_snapshot(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+        except ValueError as e:
+            # Не затираем повреждённый файл молча — откладываем его в сторону
+            broken = f"{self.path}.corrupt-{int(time.time())}"
+            os.replace(self.path, broken)
+            logging.error(f"[SCHEDULE CORRUPT] {self.path} повреждён ({e}), сохранён как {broken}")
+            return []
+
+    @contextmanager
+    def _locked(self, mode):
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, mode)
+            yield
+
+    def _snapshot_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns
+
+    def _journal_size(self):
+        try:
+            return os.path.getsize(self.journal_path)
+        except FileNotFoundError:
+            return 0
+
+    def _read_state(self):
+        # Снимок и весь журнал. Под блокировкой, чтобы не попасть между
+        # заменой снимка и очисткой журнала другой копией. Блокировка
+        # исключительная: оборванную при падении строку журнал теряет.
+        with self._locked(fcntl.LOCK_EX):
+            self.snapshot_stamp = self._snapshot_stamp()
+            return self._read_snapshot(), self._read_journal(0, whole=True)
+
+    def _read_journal(self, offset, whole=False):
+        # Записи с offset до конца. Недописанную последнюю строку (другая
+        # копия как раз пишет) оставляем до следующего раза. При чтении
+        # целиком (whole, под LOCK_EX) писать некому — это обрыв записи при
+        # падении: обрезаем журнал до неё, иначе следующая запись склеится
+        # с обрывком и тоже пропадёт.
+        try:
+            f = open(self.journal_path, "rb")
+        except FileNotFoundError:
+            self.journal_offset = 0
+            return []
+        with f:
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        if whole and end < len(data):
+            logging.warning(f"[SCHEDULE JOURNAL] отброшена оборванная запись: {data[end:end + 80]!r}")
+            os.truncate(self.journal_path, offset + end)
+        self.journal_offset = offset + end
+        records = []
+        for line in data[:end].decode("utf-8", errors="replace").splitlines():
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Обрыв записи при падении — остальное применяем
+                logging.warning(f"[SCHEDULE JOURNAL] пропущена битая запись: {line[:80]}")
+        return records
+
+    def _read_changes(self):
+        # Для sync(): только новые строки журнала либо, если другая копия
+        # успела сжать журнал, снимок и журнал целиком
+        with self._locked(fcntl.LOCK_SH):
+            if self._snapshot_stamp() == self.snapshot_stamp and self._journal_size() >= self.journal_offset:
+                return None, self._read_journal(self.journal_offset)
+        return self._read_state()
+
+    async def sync(self):
+        # Подтягивает изменения других копий бота. Возвращает их записи
+        # журнала. После полной перечитки часть записей уже свёрнута в
+        # снимок: посты, появившиеся в outbox, возвращаются как записи send.
+        snapshot, records = await run_io("journal", self._read_changes)
+        foreign = [record for record in records if record.get("by") != REPLICA_ID]
+        if snapshot is not None:
+            known = set(self.outbox) | {r["post"]["id"] for r in foreign if r["op"] == "send"}
+            # Свои записи, ещё не дошедшие до диска, накатываем поверх
+            unwritten = "".join(self.writing_lines + self.pending_lines).splitlines()
+            self._reset(snapshot, records + [json.loads(line) for line in unwritten])
+            return foreign + [{"op": "send", "post": post} for post_id, post in self.outbox.items() if post_id not in known]
+        for record in foreign:
+            self._apply(record)
+            if record["op"] == "put" and record["post"]["id"] in self.posts:
+                heapq.heappush(self.heap, (record["post"]["datetime"], record["post"]["id"]))
+                self._notify(record["post"]["id"], record["post"])
+            elif record["op"] in ("del", "send"):
+                self._notify(record.get("id") or record["post"]["id"], None)
+        self.journal_records += len(foreign)
+        self._compact_heap()
+        return foreign
+
+    def _apply(self, record):
+        if record["op"] == "put":
+            if record["post"]["id"] in self.outbox or record["post"]["id"] in self.finished:
+                # Правка, разминувшаяся с отправкой на другой копии
+                return
+            self.posts[record["post"]["id"]] = record["post"]
+        elif record["op"] == "del":
+            self.posts.pop(record["id"], None)
+        elif record["op"] == "forget":
+            self.finished.pop(record["id"], None)
+        elif record["op"] == "send":
+            post = record["post"]
+            self.posts.pop(post["id"], None)
+            self.finished.pop(post["id"], None)
+            self.outbox[post["id"]] = post
+        elif record["op"] == "flight":
+            post = self.outbox.get(record["id"])
+            if post is not None:
+                in_flight = [c for c in post.get("in_flight", []) if c != record["chat"]]
+                post["in_flight"] = in_flight + [record["chat"]] if record["value"] else in_flight
+        elif record["op"] == "result":
+            post = self.outbox.get(record["id"])
+            if post is None:
+                return
+            post["results"][record["chat"]] = record["status"]
+            post["in_flight"] = [c for c in post.get("in_flight", []) if c != record["chat"]]
+            if all(str(chat_id) in post["results"] for chat_id in post["targets"]):
+                # Результат есть по всем каналам — пост выходит из outbox
+                del self.outbox[record["id"]]
+                self.finished[record["id"]] = {
+                    "id": record["id"],
+                    "status": "sent" if all(r == "sent" for r in post["results"].values()) else "failed",
+                    "results": post["results"],
+                    "finished_at": record["at"]
+                }
+                while len(self.finished) > OUTBOX_HISTORY:
+                    self.finished.popitem(last=False)
+
+    def _append(self, *records, compact=True):
+        self.pending_lines.extend(json.dumps({**r, "by": REPLICA_ID}, ensure_ascii=False) + "\n" for r in records)
+        self.journal_records += len(records)
+        if compact and self.journal_records >= JOURNAL_COMPACT_EVERY:
+            self.compact_pending = True
+        self._schedule_write()
+
+    def compact(self):
+        if not self.journal_records and os.path.exists(self.path):
+            return
+        self.compact_pending = True
+        self._schedule_write()
+
+    def _schedule_write(self):
+        loop = running_loop()
+        if loop is None:
+            self._write(*self._take_batch())
+        elif self.flush_timer is None:
+            self.flush_timer = loop.create_task(self._write_later())
+
+    async def _write_later(self):
+        await asyncio.sleep(WRITE_BEHIND_DELAY)
+        self.flush_timer = None
+        await self._write_batch()
+
+    async def flush(self):
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        # Даже пустая пачка встаёт в очередь за уже начатыми записями
+        await self._write_batch()
+
+    async def _write_batch(self):
+        lines, snapshot = self._take_batch()
+        self.writing_lines.append(lines)
+        try:
+            await run_io("journal", self._write, lines, snapshot)
+        finally:
+            self.writing_lines.remove(lines)
+
+    def _take_batch(self):
+        # Посты для снимка копируются здесь, в event loop, а в JSON
+        # превращаются уже в потоке: меняются они только заменой полей
+        # верхнего уровня, кроме results/in_flight в outbox — их копируем тоже.
+        # Сжимает журнал ведущая копия; у остальных сжатие ждёт своей очереди.
+        lines = "".join(self.pending_lines)
+        self.pending_lines = []
+        if not self.compact_pending or not leader_lease.is_leader():
+            return lines, None
+        self.compact_pending = False
+        self.journal_records = 0
+        snapshot = [dict(post) for post in self.posts.values()]
+        snapshot += [dict(post, results=dict(post["results"]), in_flight=list(post.get("in_flight", []))) for post in self.outbox.values()]
+        snapshot += [dict(entry) for entry in self.finished.values()]
+        return lines, snapshot
+
+    def _write(self, lines, snapshot):
+        with self._locked(fcntl.LOCK_EX):
+            # Другая копия дописала журнал или сменила снимок после нашего
+            # чтения: снимок без её записей писать нельзя, ждём sync()
+            current = self._snapshot_stamp() == self.snapshot_stamp and self._journal_size() == self.journal_offset
+            if snapshot is not None and current:
+                # Снимок содержит всё состояние, строки журнала с ним не нужны
+                write_file_atomic(self.path, json.dumps(snapshot, ensure_ascii=False, indent=2).encode("utf-8"))
+                # Падение между replace и очисткой безопасно: повторное применение
+                # журнала к новому снимку ничего не меняет
+                open(self.journal_path, "w").close()
+                self.snapshot_stamp = self._snapshot_stamp()
+                self.journal_offset = 0
+                return
+            if snapshot is not None:
+                self.compact_pending = True
+            if lines:
+                with open(self.journal_path, "a", encoding="utf-8") as f:
+                    f.write(lines)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    if current:
+                        self.journal_offset = f.tell()
+
+    def _rebuild_heap(self):
+        self.heap = [(post["datetime"], post_id) for post_id, post in self.posts.items()]
+        heapq.heapify(self.heap)
+
+    def all(self):
+        return list(self.posts.values())
+
+    def get(self, post_id):
+        return self.posts.get(post_id)
+
+    def _claim_id(self, post):
+        # put для id из outbox или finished _apply пропускает, иначе правка,
+        # разминувшаяся с отправкой, вернула бы пост в расписание. Новый пост
+        # с id уже отправленного (экспорт → правка → импорт) сначала явно
+        # забывает старую отправку; id поста, который ещё отправляется, заменяется.
+        if post["id"] in self.outbox:
+            logging.warning(f"[SCHEDULE] пост {post['id']} ещё отправляется, новый получит другой id")
+            post["id"] = uuid.uuid4().hex
+        elif post["id"] in self.finished:
+            del self.finished[post["id"]]
+            return [{"op": "forget", "id": post["id"]}]
         return []
 
-def save_scheduled_posts(posts):
-    with open(SCHEDULED_POSTS_FILE, "w", encoding="utf-8") as f:
-        json.dump(posts, f, ensure_ascii=False, indent=2)
+    def add(self, post):
+        post.setdefault("id", uuid.uuid4().hex)
+        post.setdefault("targets", list(CHANNEL_IDS))
+        forget = self._claim_id(post)
+        self.posts[post["id"]] = post
+        heapq.heappush(self.heap, (post["datetime"], post["id"]))
+        self._append(*forget, {"op": "put", "post": post})
+        self._notify(post["id"], post)
+        return post
+
+    def add_many(self, posts):
+        # Пачка постов одной записью в журнал. Сжатие откладывается до
+        # явного compact(), чтобы большой импорт не переписывал снимок на
+        # каждой пачке. Пост с уже известным id заменяет старый.
+        forget = []
+        for post in posts:
+            post.setdefault("id", uuid.uuid4().hex)
+            forget += self._claim_id(post)
+            old = self.posts.get(post["id"])
+            post.setdefault("targets", old.get("targets") if old else list(CHANNEL_IDS))
+            self.posts[post["id"]] = post
+            heapq.heappush(self.heap, (post["datetime"], post["id"]))
+        self._compact_heap()
+        self._append(*forget, *({"op": "put", "post": post} for post in posts), compact=False)
+        for post in posts:
+            self._notify(post["id"], post)
+
+    def replace(self, post_id, new_post):
+        new_post["id"] = post_id
+        new_post.setdefault("targets", self.posts[post_id].get("targets") or list(CHANNEL_IDS))
+        self.posts[post_id] = new_post
+        heapq.heappush(self.heap, (new_post["datetime"], post_id))
+        self._compact_heap()
+        self._append({"op": "put", "post": new_post})
+        self._notify(post_id, new_post)
+
+    def reschedule(self, post_id, new_datetime):
+        self.posts[post_id]["datetime"] = new_datetime
+        heapq.heappush(self.heap, (new_datetime, post_id))
+        self._compact_heap()
+        self._append({"op": "put", "post": self.posts[post_id]})
+        self._notify(post_id, self.posts[post_id])
+
+    def remove(self, post_id):
+        post = self.posts.pop(post_id, None)
+        if post is not None:
+            self._compact_heap()
+            self._append({"op": "del", "id": post_id})
+            self._notify(post_id, None)
+        return post
+
+    def _compact_heap(self):
+        # Не даём куче разрастаться из-за устаревших записей
+        if len(self.heap) > 2 * len(self.posts) + 64:
+            self._rebuild_heap()
+
+    def next_due(self):
+        while self.heap:
+            dt, post_id = self.heap[0]
+            post = self.posts.get(post_id)
+            if post is not None and post["datetime"] == dt:
+                return dt
+            heapq.heappop(self.heap)
+        return None
 
-async def check_scheduled_posts():
-    now = datetime.now().strftime("%Y-%m-%d %H:%M")
-    posts = load_scheduled_posts()
-    remaining = []
+    def pop_due(self, now):
+        # Все посты со временем <= now, в порядке времени публикации.
+        # Посты не удаляются, а переходят в outbox до подтверждения отправки.
+        due = []
+        while True:
+            dt = self.next_due()
+            if dt is None or dt > now:
+                break
+            _, post_id = heapq.heappop(self.heap)
+            post = self.posts.pop(post_id)
+            post.update(status="sending", targets=post_targets(post), results={}, in_flight=[])
+            self.outbox[post_id] = post
+            due.append(post)
+        if due:
+            self._append(*({"op": "send", "post": post} for post in due))
+            for post in due:
+                self._notify(post["id"], None)
+        return due
+
+    def enqueue(self, post, targets=None):
+        # Сразу в outbox, минуя расписание: новости и повтор неотправленных.
+        # targets — повторить только эти каналы поста.
+        current = self.outbox.get(post.get("id"))
+        if current is not None:
+            # Пост ещё отправляется: новые каналы добавляются к его targets,
+            # иначе результат по ним не запишется
+            post = current
+            post["targets"] = post["targets"] + [str(c) for c in targets or [] if str(c) not in post["targets"]]
+        else:
+            post.setdefault("id", uuid.uuid4().hex)
+            post.update(targets=[str(c) for c in targets] if targets else post_targets(post), results={}, in_flight=[])
+        for chat_id in targets or []:
+            post["results"].pop(str(chat_id), None)
+        post["status"] = "sending"
+        self.finished.pop(post["id"], None)
+        self.outbox[post["id"]] = post
+        self._append({"op": "send", "post": post})
+        return post
+
+    def pending(self):
+        return list(self.outbox.values())
+
+    def signal(self, record):
+        # Запись только для других копий (см. sync_replicas): состояние
+        # расписания она не меняет
+        self._append(record)
+
+    def is_sent(self, post_id, chat_id):
+        post = self.outbox.get(post_id) or self.finished.get(post_id) or {}
+        return post.get("results", {}).get(str(chat_id)) == "sent"
+
+    def set_in_flight(self, post_id, chat_id, value):
+        # True, если в журнал добавлена запись
+        post = self.outbox.get(post_id)
+        if post is None or (str(chat_id) in post.get("in_flight", [])) == value:
+            return False
+        record = {"op": "flight", "id": post_id, "chat": str(chat_id), "value": value}
+        self._apply(record)
+        self._append(record)
+        return True
+
+    def record_result(self, post_id, chat_id, status):
+        if post_id not in self.outbox:
+            return
+        record = {"op": "result", "id": post_id, "chat": str(chat_id), "status": status, "at": datetime.now().strftime(DATETIME_FORMAT)}
+        self._apply(record)
+        self._append(record)
+
+def post_targets(post):
+    # Старые посты без списка каналов уходят во все каналы по умолчанию
+    return [str(chat_id) for chat_id in post.get("targets") or CHANNEL_IDS]
+
+def post_for_chat(post, chat_id):
+    # Языковые версии: поля из post["variants"][канал] заменяют основные
+    variant = post.get("variants", {}).get(str(chat_id))
+    if not variant:
+        return post
+    merged = {**post, **variant}
+    if "rendered" not in variant:
+        # Разметка основного текста к версии не подходит — разберём заново
+        merged.pop("rendered", None)
+    return merged
+
+schedule = ScheduledPosts(SCHEDULED_POSTS_FILE, SCHEDULED_JOURNAL_FILE, SCHEDULED_LOCK_FILE)
+
+class MarkdownError(ValueError):
+    # Разметку поста Telegram не примет — повторять отправку бесполезно
+    pass
+
+def rendered(post):
+    # Текст и entities, разобранные при сохранении (render_post).
+    # Посты, сохранённые до появления кэша, разбираются здесь. Подписи
+    # альбомов раньше уходили без parse_mode — у старых альбомов они
+    # остаются простым текстом, иначе _ и * в подписи пропали бы.
+    if "rendered" not in post:
+        if post["type"] == "album":
+            post["rendered"] = {"captions": [{"caption": m.get("caption", ""), "caption_entities": []} for m in post["media"]]}
+        else:
+            render_post(post)
+    return post["rendered"]
+
+def caption_args(caption):
+    return {"caption": caption["caption"], "caption_entities": [types.MessageEntity(**e) for e in caption["caption_entities"]]}
+
+async def send_post(chat_id, post, **kwargs):
+    # kwargs (например, reply_markup) — только для постов из одного сообщения
+    if post["type"] == "text":
+        text = rendered(post)
+        await bot.send_message(chat_id, text["text"], entities=[types.MessageEntity(**e) for e in text["entities"]], **kwargs)
+
+    elif post["type"] == "photo":
+        await bot.send_photo(chat_id, post["file_id"], **caption_args(rendered(post)), **kwargs)
+
+    elif post["type"] == "album":
+        media = []
+        for m, caption in zip(post["media"], rendered(post)["captions"]):
+            media.append(InputMediaPhoto(media=m["media"], **caption_args(caption)))
+        await bot.send_media_group(chat_id, media)
+    elif post["type"] == "photo_file":
+        await send_photo_file(chat_id, post, **kwargs)
+
+async def send_photo_file(chat_id, post, **kwargs):
+    # Файл загружается в Telegram один раз, дальше отправляется только file_id
+    sent = await bot.send_photo(chat_id, media_cache.photo(post), **caption_args(rendered(post)), **kwargs)
+    media_cache.remember_file_id(post, sent)
+    return sent
+
+# === Публикация: очередь, лимиты Telegram и повторы ===
+GLOBAL_SEND_RATE = 30        # сообщений в секунду на бота
+CHAT_SEND_RATE = 20 / 60     # сообщений в секунду в один канал
+CHAT_SEND_BURST = 3
+PUBLISH_MAX_ATTEMPTS = 5
+PUBLISH_BACKOFF_BASE = 2     # секунды, удваивается с каждой попыткой
+PUBLISH_BACKOFF_MAX = 300
+PUBLISH_STOP_TIMEOUT = 10    # секунды на завершение начатых отправок при остановке
+DEAD_LETTERS_FILE = "dead_letters.json"
+
+# Ошибки, которые не исправятся повтором (неверный Markdown, нет прав и т.п.)
+PERMANENT_SEND_ERRORS = (BadRequest, Unauthorized, NotFound, MarkdownError)
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def pause(self, seconds):
+        # RetryAfter: не отправляем ничего, пока не истечёт пауза
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class Publisher:
+    # У каждого канала своя очередь и свой воркер: пауза RetryAfter, ошибки
+    # или медленные ответы одного канала не задерживают остальные, а общий
+    # лимит бота держит global_bucket. Результат отправки в каждый канал
+    # записывается в outbox расписания; для постов не из outbox (замеры,
+    # тесты) это ничего не делает.
+    #
+    # Работает только на ведущей копии (start/stop — при смене роли). На
+    # остальных publish ничего не делает: пост ждёт в outbox, пока его не
+    # подхватит ведущая, а список неотправленных они читают с диска.
+
+    def __init__(self, dead_letters_path, outbox):
+        self.dead_letters_path = dead_letters_path
+        self.dead_letters = []
+        self.dead_letters_file = WriteBehindFile(
+            dead_letters_path, lambda: json.dumps(self.dead_letters, ensure_ascii=False, indent=2).encode("utf-8")
+        )
+        self.outbox = outbox
+        self.active = False
+        self.lanes = {}  # канал → (очередь, воркер)
+        self.deliveries = set()
+        self.global_bucket = TokenBucket(GLOBAL_SEND_RATE, GLOBAL_SEND_RATE)
+        self.chat_buckets = {}
+
+    def load(self):
+        try:
+            with open(self.dead_letters_path, "r", encoding="utf-8") as f:
+                self.dead_letters = json.load(f)
+        except FileNotFoundError:
+            self.dead_letters = []
+
+    def save_dead_letters(self):
+        # Файл пишет только ведущая копия
+        if self.active:
+            self.dead_letters_file.mark_dirty()
+
+    def current_dead_letters(self):
+        if not self.active:
+            self.load()
+        return self.dead_letters
+
+    def start(self):
+        self.lanes = {}
+        self.active = True
+
+    async def stop(self):
+        self.active = False
+        workers = [worker for _, worker in self.lanes.values()]
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        # Даём начатым запросам дойти до конца, чтобы результат попал в outbox.
+        # Отправки, которые ещё ждут лимита, отменять безопасно — они доставятся после рестарта.
+        if self.deliveries:
+            await asyncio.wait(self.deliveries, timeout=PUBLISH_STOP_TIMEOUT)
+        for delivery in self.deliveries:
+            delivery.cancel()
+
+    def queued(self):
+        return sum(queue.qsize() for queue, _ in self.lanes.values())
+
+    def publish(self, post):
+        # Во все каналы поста, по которым ещё нет результата
+        for chat_id in post_targets(post):
+            if chat_id not in post.get("results", {}):
+                self.submit(chat_id, post)
+
+    def submit(self, chat_id, post, attempt=0):
+        if not self.active:
+            return
+        chat_id = str(chat_id)
+        if chat_id not in self.lanes:
+            queue = asyncio.Queue()
+            self.lanes[chat_id] = (queue, asyncio.create_task(self._worker(chat_id, queue)))
+        self.lanes[chat_id][0].put_nowait((post, attempt))
+
+    def _chat_bucket(self, chat_id):
+        if chat_id not in self.chat_buckets:
+            self.chat_buckets[chat_id] = TokenBucket(CHAT_SEND_RATE, CHAT_SEND_BURST)
+        return self.chat_buckets[chat_id]
+
+    async def _worker(self, chat_id, queue):
+        while True:
+            post, attempt = await queue.get()
+            delivery = asyncio.ensure_future(self._process(chat_id, post, attempt))
+            self.deliveries.add(delivery)
+            delivery.add_done_callback(self.deliveries.discard)
+            # Отмена воркера при остановке не обрывает начатую отправку
+            await asyncio.shield(delivery)
+
+    async def _process(self, chat_id, post, attempt):
+        try:
+            await self._deliver(chat_id, post, attempt)
+        except Exception as e:
+            logging.exception(f"[PUBLISHER ERROR] {e}")
 
-    for post in posts:
-        if post["datetime"] == now:
-            try:
-                if post["type"] == "text":
-                    await bot.send_message(CHANNEL_ID, post["text"], parse_mode=ParseMode.MARKDOWN)
-
-                elif post["type"] == "photo":
-                    await bot.send_photo(CHANNEL_ID, post["file_id"], caption=post.get("caption", ""), parse_mode=ParseMode.MARKDOWN)
-
-                elif post["type"] == "album":
-                    media = []
-                    for m in post["media"]:
-                        item = InputMediaPhoto(media=m["media"], caption=m.get("caption", ""))
-                        media.append(item)
-                    await bot.send_media_group(CHANNEL_ID, media)
-                elif post["type"] == "photo_file":
-                    photo = InputFile(post["path"])
-                    await bot.send_photo(CHANNEL_ID, photo, caption=post.get("caption", ""), parse_mode=ParseMode.MARKDOWN)
-                    os.remove(post["path"])  # 🧹 Удаляем временный файл
-
-            except Exception as e:
-                logging.error(f"[SEND ERROR] {e}")
+    async def _deliver(self, chat_id, post, attempt):
+        if self.outbox.is_sent(post.get("id"), chat_id):
+            logging.info(f"[SEND SKIPPED] {post['id']} уже опубликован в {chat_id}")
+            return
+        chat_bucket = self._chat_bucket(chat_id)
+        await chat_bucket.acquire()
+        await self.global_bucket.acquire()
+        if not leader_lease.is_leader():
+            # Аренда истекла, пока ждали лимита: пост доставит новая ведущая копия
+            logging.warning(f"[SEND SKIPPED] {post.get('id')} → {chat_id}: копия больше не ведущая")
+            return
+        try:
+            if self.outbox.set_in_flight(post.get("id"), chat_id, True):
+                # Отметка о начале отправки должна быть на диске до запроса
+                await self.outbox.flush()
+            await send_post(chat_id, post_for_chat(post, chat_id))
+        except RetryAfter as e:
+            self.outbox.set_in_flight(post.get("id"), chat_id, False)
+            # Flood control: ждём ровно столько, сколько просит Telegram, попытку не тратим
+            POSTS_SENT.labels(post["type"], "rate_limited").inc()
+            logging.warning(f"[SEND RETRY AFTER] {chat_id}: {e.timeout} с")
+            chat_bucket.pause(e.timeout)
+            self.submit(chat_id, post, attempt)
+        except PERMANENT_SEND_ERRORS as e:
+            self._dead_letter(chat_id, post, e)
+        except Exception as e:
+            self.outbox.set_in_flight(post.get("id"), chat_id, False)
+            attempt += 1
+            if attempt >= PUBLISH_MAX_ATTEMPTS:
+                self._dead_letter(chat_id, post, e)
+                return
+            POSTS_SENT.labels(post["type"], "retry").inc()
+            delay = min(PUBLISH_BACKOFF_BASE * 2 ** attempt, PUBLISH_BACKOFF_MAX) * random.uniform(0.5, 1)
+            logging.warning(f"[SEND ERROR] {e}; попытка {attempt} из {PUBLISH_MAX_ATTEMPTS}, повтор через {delay:.0f} с")
+            asyncio.get_running_loop().call_later(delay, self.submit, chat_id, post, attempt)
         else:
-            remaining.append(post)
+            self.outbox.record_result(post.get("id"), chat_id, "sent")
+            POSTS_SENT.labels(post["type"], "sent").inc()
+            PUBLISH_LAG.observe(max(0, time.time() - datetime.strptime(post["datetime"], DATETIME_FORMAT).timestamp()))
+            logging.info(f"[POST PUBLISHED] {post.get('id')} → {chat_id}")
+
+    def _dead_letter(self, chat_id, post, error):
+        self.outbox.record_result(post.get("id"), chat_id, "failed")
+        POSTS_SENT.labels(post["type"], "failed").inc()
+        logging.error(f"[SEND FAILED] {post.get('id')} → {chat_id}: {error}")
+        self.dead_letters.append({
+            "chat_id": chat_id,
+            "post": post,
+            "error": str(error),
+            "failed_at": datetime.now().strftime(DATETIME_FORMAT)
+        })
+        self.save_dead_letters()
+
+    def retry_dead_letters(self):
+        letters, self.dead_letters = self.current_dead_letters(), []
+        self.save_dead_letters()
+        for letter in letters:
+            self.submit(letter["chat_id"], self.outbox.enqueue(letter["post"], [letter["chat_id"]]))
+        return len(letters)
+
+    def clear_dead_letters(self):
+        self.dead_letters = []
+        self.save_dead_letters()
+        if not self.active:
+            self.outbox.signal({"op": "clear_dead_letters"})
+
+    def publish_foreign(self, post):
+        # Пост поставила в outbox другая копия (новость или повтор
+        # неотправленного): его неотправленные по этим каналам больше не нужны
+        pending = [chat_id for chat_id in post_targets(post) if chat_id not in post.get("results", {})]
+        letters = [l for l in self.dead_letters if not (l["post"].get("id") == post["id"] and str(l["chat_id"]) in pending)]
+        if len(letters) != len(self.dead_letters):
+            self.dead_letters = letters
+            self.save_dead_letters()
+        self.publish(post)
+
+publisher = Publisher(DEAD_LETTERS_FILE, schedule)
+
+# Восстановление после простоя: что делать с постами, время которых прошло
+MISFIRE_GRACE_MINUTES = int(os.getenv("MISFIRE_GRACE_MINUTES", 6 * 60))
+MISFIRE_POLICY = os.getenv("MISFIRE_POLICY", "skip")          # skip — опоздавшие сверх grace в неотправленные, send — публиковать всё
+INFLIGHT_POLICY = os.getenv("INFLIGHT_POLICY", "resend")      # resend — повторить прерванную отправку, hold — в неотправленные
+RECOVERY_INTERVAL = int(os.getenv("RECOVERY_INTERVAL", 60))   # секунды между догоняющими постами
+
+def recover_outbox():
+    # Запускается до первого тика. Посты, застрявшие в outbox, и посты,
+    # чьё время прошло, пока бот был выключен, не вываливаются в каналы
+    # пачкой, а идут с интервалом RECOVERY_INTERVAL.
+    now = datetime.now()
+    grace_start = (now - timedelta(minutes=MISFIRE_GRACE_MINUTES)).strftime(DATETIME_FORMAT)
+    catch_up = []
+    for post in schedule.pending():
+        if INFLIGHT_POLICY == "hold":
+            for chat_id in list(post.get("in_flight", [])):
+                publisher._dead_letter(chat_id, post, "отправка прервана перезапуском, пост мог уже выйти")
+        catch_up.append(post)
+    for post in schedule.pop_due(now.strftime(DATETIME_FORMAT)):
+        if post["datetime"] < grace_start and MISFIRE_POLICY == "skip":
+            for chat_id in post["targets"]:
+                publisher._dead_letter(chat_id, post, f"время публикации {post['datetime']} пропущено, бот был выключен")
+        else:
+            catch_up.append(post)
+
+    # Посты, у которых уже есть результат по всем каналам, publish пропустит
+    loop = asyncio.get_running_loop()
+    for i, post in enumerate(catch_up):
+        loop.call_later(i * RECOVERY_INTERVAL, publisher.publish, post)
+    if catch_up:
+        logging.info(f"[OUTBOX RECOVERY] {len(catch_up)} постов будут опубликованы с интервалом {RECOVERY_INTERVAL} с")
 
-    save_scheduled_posts(remaining)
+async def check_scheduled_posts():
+    # Тик стоит O(1), пока ничего не пора публиковать, и O(log n) на пост.
+    # Сравнение "<=" вместо "==" — посты не теряются, если тик пропустил минуту.
+    with TICK_DURATION.time():
+        health["last_tick"] = time.time()
+        now = datetime.now().strftime(DATETIME_FORMAT)
+        for post in schedule.pop_due(now):
+            publisher.publish(post)
+
+# === Несколько копий бота ===
+# Копии на одном хосте (вебхук за балансировщиком, перезапуск без простоя)
+# обрабатывают обновления все, а публикует только держатель аренды
+# leader_lease. Изменения расписания копии видят через общий журнал.
+REPLICA_SYNC_SECONDS = 2
+lease_task = None
+
+async def sync_replicas():
+    records = await schedule.sync()
+    for record in records:
+        # Запланированные посты окно дублей получает от слушателя расписания,
+        # новости и удаления — отсюда
+        if record["op"] == "send":
+            post = record["post"]
+            duplicates.add(post["id"], dedup_text(post), post.get("source") or f"пост на {post['datetime']}")
+        elif record["op"] == "del":
+            duplicates.remove(record["id"])
+    if not publisher.active:
+        # Тикает у ведущей копии; для остальных признак жизни — синхронизация
+        health["last_tick"] = time.time()
+        return
+    for record in records:
+        if record["op"] == "send" and record["post"]["id"] in schedule.outbox:
+            publisher.publish_foreign(schedule.outbox[record["post"]["id"]])
+        elif record["op"] == "clear_dead_letters":
+            publisher.clear_dead_letters()
+
+async def become_leader():
+    await schedule.sync()
+    publisher.load()
+    publisher.start()
+    recover_outbox()
+    scheduler.add_job(check_scheduled_posts, "interval", seconds=SCHEDULER_TICK_SECONDS, max_instances=1, coalesce=True, id="check_scheduled_posts")
+    logging.info(f"[LEADER] {REPLICA_ID} публикует посты")
+
+async def step_down():
+    scheduler.remove_job("check_scheduled_posts")
+    await publisher.stop()
+    await publisher.dead_letters_file.flush()
+    logging.warning(f"[LEADER LOST] {REPLICA_ID} больше не ведущая копия")
+
+async def hold_lease():
+    # Ведущая продлевает аренду, остальные пытаются её забрать
+    while True:
+        try:
+            try:
+                acquired = await run_io("lease", leader_lease.acquire)
+            except sqlite3.Error as e:
+                logging.warning(f"[LEASE ERROR] {e}")
+                acquired = leader_lease.is_leader()
+            if acquired and not publisher.active:
+                await become_leader()
+            elif not acquired and publisher.active:
+                await step_down()
+        except Exception as e:
+            logging.exception(f"[LEASE ERROR] {e}")
+        await asyncio.sleep(LEADER_LEASE_RENEW)
 
 # === Поддержка ссылок на изображения ===
+IMAGE_DIR = "tmp_images"
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", 10 * 1024 * 1024))
+IMAGE_DOWNLOAD_TIMEOUT = int(os.getenv("IMAGE_DOWNLOAD_TIMEOUT", 30))
+IMAGE_DOWNLOAD_CONCURRENCY = int(os.getenv("IMAGE_DOWNLOAD_CONCURRENCY", 4))
+IMAGE_CHUNK_SIZE = 64 * 1024
+IMAGE_ORPHAN_AGE = 3600  # секунды; более свежие файлы могут ещё ждать подтверждения
+
+http_session = None  # общий пул соединений на весь процесс
+download_semaphore = asyncio.Semaphore(IMAGE_DOWNLOAD_CONCURRENCY)
+
+def get_http_session():
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=IMAGE_DOWNLOAD_TIMEOUT, sock_connect=10),
+            connector=aiohttp.TCPConnector(limit=IMAGE_DOWNLOAD_CONCURRENCY * 2)
+        )
+    return http_session
+
+async def close_http_session():
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+
 async def download_image_from_url(url):
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-                        tmp_file.write(await resp.read())
-                        return tmp_file.name
+        async with download_semaphore:
+            async with get_http_session().get(url) as resp:
+                if resp.status != 200:
+                    logging.error(f"[IMAGE DOWNLOAD ERROR] {url}: HTTP {resp.status}")
+                    return None
+                if not resp.content_type.startswith("image/"):
+                    logging.error(f"[IMAGE DOWNLOAD ERROR] {url}: не изображение ({resp.content_type})")
+                    return None
+                if resp.content_length and resp.content_length > IMAGE_MAX_BYTES:
+                    logging.error(f"[IMAGE DOWNLOAD ERROR] {url}: слишком большой файл ({resp.content_length} байт)")
+                    return None
+
+                os.makedirs(IMAGE_DIR, exist_ok=True)
+                fd, path = tempfile.mkstemp(dir=IMAGE_DIR, suffix=".img")
+                try:
+                    size = 0
+                    digest = hashlib.sha256()
+                    with os.fdopen(fd, "wb") as tmp_file:
+                        async for chunk in resp.content.iter_chunked(IMAGE_CHUNK_SIZE):
+                            size += len(chunk)
+                            if size > IMAGE_MAX_BYTES:
+                                raise ValueError(f"слишком большой файл (больше {IMAGE_MAX_BYTES} байт)")
+                            digest.update(chunk)
+                            await run_io("image", tmp_file.write, chunk)
+                except BaseException:
+                    # В том числе отмена задачи — временный файл не должен остаться
+                    os.remove(path)
+                    raise
+                return path, digest.hexdigest(), size
     except Exception as e:
-        logging.error(f"[IMAGE DOWNLOAD ERROR] {e}")
+        logging.error(f"[IMAGE DOWNLOAD ERROR] {url}: {e}")
         return None
 
+# === Кэш медиа: один файл — одна загрузка в Telegram ===
+MEDIA_CACHE_FILE = "media_cache.json"
+MEDIA_FILE_TTL = 24 * 3600               # локальная копия после получения file_id
+MEDIA_CACHE_MAX_BYTES = 200 * 1024 * 1024
+MEDIA_URL_TTL = 7 * 24 * 3600            # сколько доверяем соответствию ссылка → содержимое
+MEDIA_MAX_ENTRIES = 10000
+
+class MediaCache:
+    # items: sha256 содержимого → {"path", "size", "file_id", "last_used"},
+    # порядок OrderedDict — от давно использованных к недавним (LRU).
+    # by_url: ссылка → sha256, чтобы повторная ссылка не скачивалась заново.
+
+    def __init__(self, path):
+        self.path = path
+        self.items = OrderedDict()
+        self.by_url = {}
+        self.file = WriteBehindFile(
+            path, lambda: json.dumps({"items": self.items, "by_url": self.by_url}, ensure_ascii=False).encode("utf-8")
+        )
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        self.items = OrderedDict(sorted(data["items"].items(), key=lambda kv: kv[1]["last_used"]))
+        self.by_url = data["by_url"]
+
+    def save(self):
+        self.file.mark_dirty()
+
+    def _touch(self, sha):
+        self.items[sha]["last_used"] = time.time()
+        self.items.move_to_end(sha)
+
+    def lookup_url(self, url):
+        entry = self.by_url.get(url)
+        if not entry or time.time() - entry["ts"] > MEDIA_URL_TTL:
+            return None
+        item = self.items.get(entry["sha256"])
+        if item is None or not (item.get("file_id") or item.get("path")):
+            return None
+        self._touch(entry["sha256"])
+        return item
+
+    def add_file(self, url, path, sha, size):
+        item = self.items.get(sha)
+        if item is not None and (item.get("file_id") or item.get("path")):
+            os.remove(path)  # такое содержимое уже есть
+        else:
+            item = {"sha256": sha, "path": path, "size": size, "file_id": None}
+            self.items[sha] = item
+        self.by_url[url] = {"sha256": sha, "ts": time.time()}
+        self._touch(sha)
+        self.save()
+        return item
+
+    def photo(self, post):
+        item = self.items.get(post.get("sha256"))
+        if item is None:
+            return InputFile(post["path"])
+        self._touch(post["sha256"])
+        return item.get("file_id") or InputFile(item["path"])
+
+    def remember_file_id(self, post, message):
+        item = self.items.get(post.get("sha256"))
+        if item is not None and not item.get("file_id"):
+            item["file_id"] = message.photo[-1].file_id
+            self.save()
+
+    def evict(self, in_use):
+        # Файлы с известным file_id удаляем по TTL и по общему объёму (LRU),
+        # файлы без file_id — только если на них не ссылается ни один пост.
+        now = time.time()
+        total = sum(item["size"] for item in self.items.values() if item.get("path"))
+        for sha, item in list(self.items.items()):
+            if not item.get("path"):
+                continue
+            idle = now - item["last_used"]
+            if item.get("file_id"):
+                if idle > MEDIA_FILE_TTL or total > MEDIA_CACHE_MAX_BYTES:
+                    self._remove_file(item)
+                    total -= item["size"]
+            elif sha not in in_use and idle > IMAGE_ORPHAN_AGE:
+                self._remove_file(item)
+                total -= item["size"]
+                del self.items[sha]
+        for sha in list(self.items):
+            if len(self.items) <= MEDIA_MAX_ENTRIES:
+                break
+            if sha not in in_use:
+                self._remove_file(self.items.pop(sha))
+        self.by_url = {
+            url: entry for url, entry in self.by_url.items()
+            if entry["sha256"] in self.items and now - entry["ts"] <= MEDIA_URL_TTL
+        }
+        self.save()
+
+    def _remove_file(self, item):
+        if item.get("path"):
+            try:
+                os.remove(item["path"])
+            except FileNotFoundError:
+                pass
+            item["path"] = None
+
+    def known_paths(self):
+        return {os.path.abspath(item["path"]) for item in self.items.values() if item.get("path")}
+
+media_cache = MediaCache(MEDIA_CACHE_FILE)
+
+async def fetch_image(url):
+    item = media_cache.lookup_url(url)
+    if item is not None:
+        return item
+    result = await download_image_from_url(url)
+    if result is None:
+        return None
+    return media_cache.add_file(url, *result)
+
+def photo_file_post(scheduled, url, image):
+    return {
+        "datetime": scheduled,
+        "type": "photo_file",
+        "url": url,
+        "sha256": image["sha256"],
+        "path": image["path"],
+        "caption": ""
+    }
+
+def cleanup_temp_images():
+    posts = schedule.all() + fsm_storage.previews() + [letter["post"] for letter in publisher.dead_letters]
+    in_use = {p.get("sha256") for p in posts if p.get("type") == "photo_file"}
+    in_use_paths = {os.path.abspath(p["path"]) for p in posts if p.get("type") == "photo_file" and p.get("path")}
+    media_cache.evict(in_use)
+
+    # Файлы, о которых кэш не знает (например, после падения посреди загрузки)
+    if not os.path.isdir(IMAGE_DIR):
+        return
+    known = media_cache.known_paths() | in_use_paths
+    removed = 0
+    for entry in os.scandir(IMAGE_DIR):
+        if os.path.abspath(entry.path) in known:
+            continue
+        if time.time() - entry.stat().st_mtime > IMAGE_ORPHAN_AGE:
+            os.remove(entry.path)
+            removed += 1
+    if removed:
+        logging.info(f"[TEMP CLEANUP] удалено файлов: {removed}")
+
+# === Подготовка поста при подтверждении ===
+# Всё дорогое (загрузка файла, разбор разметки) делаем сразу после
+# подтверждения, чтобы в момент публикации оставался один вызов API с file_id.
+#
+# Markdown разбирается у нас, а не в Telegram: текст уходит без parse_mode,
+# с готовыми entities. Ошибка разметки видна при сохранении, а не при
+# публикации, и предпросмотр показывает ровно то, что выйдет в канал.
+MARKDOWN_ENTITIES = {"*": "bold", "_": "italic", "`": "code"}
+
+def utf16_len(text):
+    # Смещения entities Telegram считает в UTF-16: эмодзи — две единицы
+    return len(text.encode("utf-16-le")) // 2
+
+def parse_markdown(text):
+    # Старый Markdown Telegram → (текст без разметки, entities).
+    # *жирный*, _курсив_, `код`, ```язык\nблок```, [текст](ссылка).
+    # Сущности не вкладываются; \ экранирует _ * ` [ вне сущностей.
+    parts = []
+    entities = []
+    offset = 0
+
+    def add(chunk, entity=None):
+        nonlocal offset
+        length = utf16_len(chunk)
+        if entity is not None and length:
+            entity.update(offset=offset, length=length)
+            entities.append(entity)
+        parts.append(chunk)
+        offset += length
+
+    i = 0
+    plain_start = 0
+    while i < len(text):
+        c = text[i]
+        if c not in "\\*_`[":
+            i += 1
+            continue
+        add(text[plain_start:i])
+        if c == "\\":
+            if text[i + 1:i + 2] in ("_", "*", "`", "["):
+                add(text[i + 1])
+                i += 2
+            else:
+                add(c)
+                i += 1
+        elif text.startswith("```", i):
+            end = text.find("```", i + 3)
+            if end < 0:
+                raise MarkdownError(f"не закрыт блок ``` (позиция {i + 1})")
+            body = text[i + 3:end]
+            entity = {"type": "pre"}
+            first_line, newline, rest = body.partition("\n")
+            if newline and first_line and not any(ch.isspace() for ch in first_line):
+                entity["language"] = first_line
+                body = rest
+            elif newline and not first_line:
+                body = rest
+            add(body, entity)
+            i = end + 3
+        elif c in MARKDOWN_ENTITIES:
+            end = text.find(c, i + 1)
+            if end < 0:
+                raise MarkdownError(f"не закрыт символ {c} (позиция {i + 1})")
+            add(text[i + 1:end], {"type": MARKDOWN_ENTITIES[c]})
+            i = end + 1
+        else:
+            close = text.find("]", i + 1)
+            if close < 0:
+                raise MarkdownError(f"не закрыта скобка [ (позиция {i + 1})")
+            if not text.startswith("(", close + 1):
+                # [текст] без ссылки остаётся как есть
+                add(text[i:close + 1])
+                i = close + 1
+            else:
+                end = text.find(")", close + 2)
+                if end < 0:
+                    raise MarkdownError(f"не закрыта ссылка (позиция {i + 1})")
+                url = text[close + 2:end].strip()
+                if re.match(r"[\w-]+(\.[\w-]+)+(/\S*)?$", url):
+                    url = "http://" + url
+                elif not re.match(r"(https?|tg)://\S+$", url):
+                    raise MarkdownError(f"неверная ссылка {url!r} (позиция {close + 3})")
+                add(text[i + 1:close], {"type": "text_link", "url": url})
+                i = end + 1
+        plain_start = i
+    add(text[plain_start:])
+    return strip_entities("".join(parts), entities)
+
+def strip_entities(text, entities):
+    # Telegram обрезает пробелы по краям сообщения — сдвигаем entities сами
+    lead = utf16_len(text) - utf16_len(text.lstrip())
+    text = text.strip()
+    size = utf16_len(text)
+    result = []
+    for entity in entities:
+        start = max(entity["offset"] - lead, 0)
+        end = min(entity["offset"] + entity["length"] - lead, size)
+        if end > start:
+            result.append(dict(entity, offset=start, length=end - start))
+    return text, result
+
+def render_caption(caption):
+    text, entities = parse_markdown(caption)
+    if len(text) > CAPTION_LIMIT:
+        raise MarkdownError(f"подпись длиннее {CAPTION_LIMIT} символов")
+    return {"caption": text, "caption_entities": entities}
+
+def render_fields(post):
+    if post["type"] == "text":
+        text, entities = parse_markdown(post["text"])
+        if not text:
+            raise MarkdownError("после разметки текст пустой")
+        if len(text) > MESSAGE_LIMIT:
+            raise MarkdownError(f"текст длиннее {MESSAGE_LIMIT} символов")
+        return {"text": text, "entities": entities}
+    if post["type"] == "album":
+        return {"captions": [render_caption(m.get("caption", "")) for m in post["media"]]}
+    return render_caption(post.get("caption", ""))
+
+def render_post(post):
+    # Разбирает разметку поста и его языковых версий и кладёт результат в
+    # post["rendered"]. MarkdownError — такой пост Telegram не примет.
+    post["rendered"] = render_fields(post)
+    for variant in post.get("variants", {}).values():
+        variant["rendered"] = render_fields({**post, **variant})
+    return post
+
+async def stage_post(post):
+    render_post(post)
+
+    if post["type"] == "photo_file":
+        photo = media_cache.photo(post)
+        if isinstance(photo, InputFile):
+            # Предпросмотр не успел загрузить файл — загружаем в служебный чат
+            sent = await bot.send_photo(STAGING_CHAT_ID, photo, disable_notification=True)
+            media_cache.remember_file_id(post, sent)
+            await sent.delete()
+            photo = sent.photo[-1].file_id
+        post = {
+            "id": post.get("id"),
+            "datetime": post["datetime"],
+            "type": "photo",
+            "file_id": photo,
+            "caption": post.get("caption", ""),
+            "url": post.get("url"),
+            "rendered": post["rendered"]
+        }
+        if post["id"] is None:
+            del post["id"]
+
+    post["staged_at"] = datetime.now().isoformat(timespec="seconds")
+    return post
+
+# === Отсев почти одинаковых новостей (SimHash + LSH) ===
+DEDUP_WINDOW_SECONDS = 72 * 3600
+DEDUP_MAX_ENTRIES = 20000
+DEDUP_MAX_DISTANCE = 3   # различающихся бит из 64
+SIMHASH_BANDS = 4        # 4 полосы по 16 бит: при расстоянии <= 3 хотя бы одна совпадёт
+
+def post_text(post):
+    if post["type"] == "text":
+        return post["text"]
+    if post["type"] == "album":
+        return " ".join(m.get("caption", "") for m in post["media"])
+    return post.get("caption", "")
+
+def simhash(text):
+    text = re.sub(r"https?://\S+|t\.me/\S+", " ", normalize_text(text))
+    tokens = re.findall(r"\w+", text)
+    if not tokens:
+        return None
+    shingles = [" ".join(tokens[i:i + 3]) for i in range(max(1, len(tokens) - 2))]
+    weights = [0] * 64
+    for shingle in shingles:
+        h = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+class DuplicateIndex:
+    # Скользящее окно отпечатков. Кандидаты ищутся только в своих LSH-корзинах,
+    # поэтому проверка не зависит от размера окна.
+
+    def __init__(self):
+        self.entries = {}                  # key → (отпечаток, время, подпись, текст)
+        self.buckets = defaultdict(set)    # (полоса, значение) → ключи
+        self.order = deque()               # (время, key) в порядке добавления
+
+    def _bands(self, fp):
+        width = 64 // SIMHASH_BANDS
+        mask = (1 << width) - 1
+        return [(band, fp >> (band * width) & mask) for band in range(SIMHASH_BANDS)]
+
+    def find(self, text):
+        fp = simhash(text)
+        if fp is None:
+            return None
+        self._evict()
+        candidates = set()
+        for band in self._bands(fp):
+            candidates |= self.buckets.get(band, set())
+        for key in candidates:
+            other, _, label, _ = self.entries[key]
+            if bin(fp ^ other).count("1") <= DEDUP_MAX_DISTANCE:
+                return label
+        return None
+
+    def add(self, key, text, label):
+        entry = self.entries.get(key)
+        if entry is not None and entry[2:] == (label, text):
+            # Тот же пост пришёл ещё раз (перечитка расписания, запись другой копии)
+            return
+        fp = simhash(text)
+        if fp is None:
+            return
+        self.remove(key)
+        now = time.time()
+        self.entries[key] = (fp, now, label, text)
+        for band in self._bands(fp):
+            self.buckets[band].add(key)
+        self.order.append((now, key))
+        self._evict()
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for band in self._bands(entry[0]):
+            self.buckets[band].discard(key)
+            if not self.buckets[band]:
+                del self.buckets[band]
+
+    def _evict(self):
+        deadline = time.time() - DEDUP_WINDOW_SECONDS
+        while self.order and (self.order[0][0] < deadline or len(self.entries) > DEDUP_MAX_ENTRIES):
+            added, key = self.order.popleft()
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] == added:
+                self.remove(key)
+
+duplicates = DuplicateIndex()
+
+NEWS_SOURCE_PREFIX = "\n\n📰 Источник: "
+
+def dedup_text(post):
+    # У новости — текст исходного сообщения, как его проверяет
+    # monitor_channel_post: без экранирования и строки с источником
+    if not post.get("source"):
+        return post_text(post)
+    fields = rendered(post)
+    text = fields.get("text", fields.get("caption", ""))
+    return text.rpartition(NEWS_SOURCE_PREFIX)[0] or text
+
+def track_duplicates(post_id, post):
+    # Слушатель расписания: в окно попадают и посты, запланированные другой
+    # копией бота. Опубликованный пост остаётся в окне до вытеснения.
+    if post is not None:
+        duplicates.add(post_id, post_text(post), f"пост на {post['datetime']}")
+
+schedule.listeners.append(track_duplicates)
+
+# === Мониторинг новостей из каналов-источников ===
+# Бот должен быть администратором каналов-источников, иначе Telegram
+# не присылает ему channel_post.
+KEYWORDS_FILE = "keywords.txt"
+KEYWORDS_RELOAD_SECONDS = 5
+MESSAGE_LIMIT = 4096
+CAPTION_LIMIT = 1024
+SOURCE_CHANNELS = {c.strip().lower() for c in os.getenv("SOURCE_CHANNELS", "").split(",") if c.strip()}
+
+def normalize_text(text):
+    return text.casefold().replace("ё", "е")
+
+def escape_markdown(text):
+    return re.sub(r"([_*`\[])", r"\\\1", text)
+
+def escape_markdown_to_fit(text, limit):
+    # Экранирует и обрезает так, чтобы результат уложился в limit символов
+    cut = limit
+    while True:
+        escaped = escape_markdown(text[:cut]) + ("…" if cut < len(text) else "")
+        if len(escaped) <= limit:
+            return escaped
+        cut -= len(escaped) - limit
+
+class KeywordMatcher:
+    # Автомат Ахо — Корасик: один проход по тексту независимо от числа
+    # ключевых слов. Ключи и текст приводятся через normalize_text.
+
+    def __init__(self, keywords):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for keyword in keywords:
+            self._add(normalize_text(keyword))
+        self._build()
+
+    def _add(self, keyword):
+        state = 0
+        for ch in keyword:
+            if ch not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+                self.goto[state][ch] = len(self.goto) - 1
+            state = self.goto[state][ch]
+        self.out[state].append(keyword)
+
+    def _build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                if state:
+                    f = self.fail[state]
+                    while f and ch not in self.goto[f]:
+                        f = self.fail[f]
+                    self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def find(self, text):
+        found = set()
+        state = 0
+        for ch in normalize_text(text):
+            while state and ch not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(ch, 0)
+            if self.out[state]:
+                found.update(self.out[state])
+        return found
+
+class KeywordWatcher:
+    # Перечитывает keywords.txt, когда файл меняется (проверка mtime не чаще
+    # раза в KEYWORDS_RELOAD_SECONDS)
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.checked = 0
+        self.matcher = KeywordMatcher([])
+
+    def get(self):
+        now = time.monotonic()
+        if now - self.checked >= KEYWORDS_RELOAD_SECONDS:
+            self.checked = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if mtime != self.mtime:
+                self.mtime = mtime
+                self._reload()
+        return self.matcher
+
+    def _reload(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                keywords = [line.strip() for line in f if line.strip()]
+        except FileNotFoundError:
+            keywords = []
+        self.matcher = KeywordMatcher(keywords)
+        logging.info(f"[KEYWORDS LOADED] {len(keywords)} ключевых слов")
+
+keywords = KeywordWatcher(KEYWORDS_FILE)
+
+def is_source_channel(chat):
+    return bool(chat.username and "@" + chat.username.lower() in SOURCE_CHANNELS) or str(chat.id) in SOURCE_CHANNELS
+
+def source_link(message):
+    if message.chat.username:
+        return f"https://t.me/{message.chat.username}/{message.message_id}"
+    # Приватный канал: id вида -100XXXXXXXXXX
+    return f"https://t.me/c/{str(message.chat.id).removeprefix('-100')}/{message.message_id}"
+
+@dp.channel_post_handler(content_types=[ContentType.TEXT, ContentType.PHOTO])
+async def monitor_channel_post(message: types.Message):
+    if not is_source_channel(message.chat):
+        return
+    text = message.text or message.caption or ""
+    found = keywords.get().find(text)
+    if not found:
+        return
+
+    # Текст ссылки разметка берёт как есть, без экранирования: убираем
+    # только скобки, которые закрыли бы его раньше времени
+    title = re.sub(r"[\[\]]", "", message.chat.title or message.chat.username or "канал") or "канал"
+    attribution = f"{NEWS_SOURCE_PREFIX}[{title}]({source_link(message)})"
+    post = {
+        "id": f"news-{message.chat.id}-{message.message_id}",
+        "datetime": datetime.now().strftime(DATETIME_FORMAT),
+        "source": source_link(message)
+    }
+    if message.photo:
+        caption = escape_markdown_to_fit(text, CAPTION_LIMIT - len(attribution)) + attribution
+        post.update(type="photo", file_id=message.photo[-1].file_id, caption=caption)
+    else:
+        post.update(type="text", text=escape_markdown_to_fit(text, MESSAGE_LIMIT - len(attribution)) + attribution)
+
+    try:
+        render_post(post)
+    except MarkdownError as e:
+        logging.warning(f"[NEWS SKIPPED] {post['source']}: ошибка разметки: {e}")
+        return
+
+    duplicate = duplicates.find(text)
+    if duplicate:
+        logging.info(f"[NEWS DUPLICATE] {post['source']} похоже на {duplicate}")
+        return
+    duplicates.add(post["id"], dedup_text(post), post["source"])
+
+    logging.info(f"[NEWS MATCH] {post['source']}: {', '.join(sorted(found))}")
+    publisher.publish(schedule.enqueue(post))
+
+# === Массовый импорт и экспорт (JSONL / CSV) ===
+# Файл читается построчно генератором, каждая запись проверяется отдельно,
+# а в хранилища посты пишутся пачками: одна транзакция SQLite и одна запись
+# в журнал расписания на пачку. Ошибка в строке не останавливает импорт.
+#
+# Запись без datetime — пост библиотеки ({"text": ...}), с datetime — пост
+# в расписании. Запись с id существующего поста обновляет его, так что
+# экспорт → правка → импорт работает как массовое редактирование.
+IMPORT_BATCH_SIZE = 500
+IMPORT_MAX_ERRORS = 1000    # ошибок в отчёте; считаются все
+EXPORT_FIELDS = ["id", "datetime", "type", "text", "caption", "file_id", "url", "media", "targets"]
+
+def parse_import_lines(lines, fmt):
+    # (номер строки, запись или None, ошибка или None)
+    if fmt == "csv":
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, row, None
+        return
+    for line_no, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_no, json.loads(line), None
+        except ValueError as e:
+            yield line_no, None, f"не JSON: {e}"
+
+def split_list(value, sep):
+    # В JSONL списки — списки, в CSV — строка с разделителем
+    if isinstance(value, list):
+        return value
+    return [item.strip() for item in str(value).split(sep) if item.strip()]
+
+def import_record(record, now):
+    # ("library", (id, текст)) или ("schedule", пост); ValueError — запись не годится
+    if not isinstance(record, dict):
+        raise ValueError("ожидается объект")
+    record = {k: v for k, v in record.items() if k and v not in (None, "")}
+
+    if "datetime" not in record:
+        text = str(record.get("text", "")).strip()
+        if not text:
+            raise ValueError("нет ни datetime, ни text")
+        post_id = record.get("id")
+        if post_id is not None and not str(post_id).isdigit():
+            raise ValueError(f"id поста библиотеки должен быть числом, а не {post_id!r}")
+        return "library", (int(post_id) if post_id is not None else None, text)
+
+    try:
+        when = datetime.strptime(record["datetime"], DATETIME_FORMAT)
+    except (TypeError, ValueError):
+        raise ValueError(f"неверная дата {record['datetime']!r}, нужен формат ГГГГ-ММ-ДД ЧЧ:ММ")
+    if when.strftime(DATETIME_FORMAT) <= now:
+        raise ValueError(f"время {record['datetime']} уже прошло")
+
+    post = {"datetime": when.strftime(DATETIME_FORMAT)}
+    if "id" in record:
+        # id попадает в callback_data кнопок расписания: там ":" — разделитель,
+        # а всё вместе не длиннее 64 байт
+        if not re.fullmatch(r"[A-Za-z0-9_-]{1,32}", str(record["id"])):
+            raise ValueError(f"id поста в расписании — до 32 латинских букв, цифр, _ и -, а не {record['id']!r}")
+        post["id"] = str(record["id"])
+    if "targets" in record:
+        post["targets"] = [str(c) for c in split_list(record["targets"], ",")]
+    if isinstance(record.get("variants"), dict):
+        post["variants"] = record["variants"]
+
+    kind = record.get("type") or ("album" if "media" in record else "photo" if "file_id" in record or "url" in record else "text")
+    if kind == "text":
+        text = str(record.get("text", "")).strip()
+        if not text:
+            raise ValueError("пустой text")
+        if len(text) > MESSAGE_LIMIT:
+            raise ValueError(f"текст длиннее {MESSAGE_LIMIT} символов")
+        post.update(type="text", text=text)
+    elif kind == "photo":
+        # Ссылку Telegram скачает сам, отдельная загрузка не нужна
+        photo = record.get("file_id") or record.get("url")
+        if not photo:
+            raise ValueError("у фото нет file_id или url")
+        if "file_id" not in record and not re.match(r"https?://", photo):
+            raise ValueError(f"url должен начинаться с http:// или https://: {photo!r}")
+        post.update(type="photo", file_id=photo, caption=str(record.get("caption", "")))
+        if "url" in record:
+            post["url"] = record["url"]
+    elif kind == "album":
+        media = []
+        for item in split_list(record.get("media", []), "|"):
+            if isinstance(item, dict):
+                if not item.get("media"):
+                    raise ValueError("у элемента альбома нет media")
+                media.append({"type": "photo", "media": item["media"], "caption": str(item.get("caption", ""))})
+            else:
+                media.append({"type": "photo", "media": str(item), "caption": ""})
+        if not 2 <= len(media) <= MEDIA_GROUP_MAX_ITEMS:
+            raise ValueError(f"в альбоме должно быть от 2 до {MEDIA_GROUP_MAX_ITEMS} фото, а не {len(media)}")
+        if record.get("caption") and not media[0]["caption"]:
+            media[0]["caption"] = str(record["caption"])
+        post.update(type="album", media=media)
+    else:
+        raise ValueError(f"неизвестный type {kind!r}")
+
+    try:
+        render_post(post)
+    except MarkdownError as e:
+        raise ValueError(f"ошибка разметки: {e}")
+    return "schedule", post
+
+class BulkImport:
+    def __init__(self):
+        self.library = 0
+        self.scheduled = 0
+        self.error_count = 0
+        self.errors = []  # (номер строки, текст ошибки)
+        self.failure = None  # почему файл не дочитан до конца
+
+    def batches(self, lines, fmt):
+        # Генератор: отдаёт управление после каждой записанной пачки, чтобы
+        # хендлер бота мог вернуть управление event loop между пачками
+        now = datetime.now().strftime(DATETIME_FORMAT)
+        library, scheduled = [], []
+        try:
+            for line_no, record, error in parse_import_lines(lines, fmt):
+                if error is None:
+                    try:
+                        kind, item = import_record(record, now)
+                    except ValueError as e:
+                        error = str(e)
+                if error is not None:
+                    self.error_count += 1
+                    if len(self.errors) < IMPORT_MAX_ERRORS:
+                        self.errors.append((line_no, error))
+                    continue
+                (library if kind == "library" else scheduled).append(item)
+                if len(library) + len(scheduled) >= IMPORT_BATCH_SIZE:
+                    self._flush(library, scheduled)
+                    library, scheduled = [], []
+                    yield
+        except UnicodeDecodeError:
+            self.failure = "файл не в кодировке UTF-8"
+        except csv.Error as e:
+            self.failure = f"CSV не разобран: {e}"
+        # Записи, прочитанные до ошибки в самом файле, тоже сохраняем
+        self._flush(library, scheduled)
+        schedule.compact()
+        yield
+
+    def _flush(self, library, scheduled):
+        if library:
+            post_store.add_many(library)
+            self.library += len(library)
+        if scheduled:
+            schedule.add_many(scheduled)
+            self.scheduled += len(scheduled)
+
+    def summary(self):
+        if self.failure:
+            text = (f"⚠️ Импорт прерван: {self.failure}. До этого записано: в библиотеку {self.library}, "
+                    f"в расписание {self.scheduled}, ошибок {self.error_count}.")
+        else:
+            text = f"📥 Импорт завершён: в библиотеку {self.library}, в расписание {self.scheduled}, ошибок {self.error_count}."
+        if self.errors:
+            text += "\n\n" + "\n".join(f"строка {line_no}: {error}" for line_no, error in self.errors[:20])
+            if self.error_count > 20:
+                text += f"\n… и ещё {self.error_count - 20}"
+        return text
+
+    def error_report(self):
+        return "".join(f"строка {line_no}: {error}\n" for line_no, error in self.errors)
+
+def export_scheduled():
+    # Снимок расписания для выгрузки; снимается в цикле событий, пишется в потоке
+    return [{k: v for k, v in post.items() if k in EXPORT_FIELDS or k == "variants"} for post in schedule.all()]
+
+def export_lines(fmt, library, scheduled):
+    # Библиотека, затем расписание. Библиотека читается курсором, без загрузки всех строк
+    records = itertools.chain(({"id": row["id"], "text": row["text"]} for row in library), scheduled)
+    if fmt == "jsonl":
+        for record in records:
+            yield json.dumps(record, ensure_ascii=False) + "\n"
+        return
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, EXPORT_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    for record in records:
+        if "targets" in record:
+            record["targets"] = ",".join(record["targets"])
+        if "media" in record:
+            # В CSV у альбома остаются только file_id, подпись — в caption
+            record["caption"] = record["media"][0].get("caption", "")
+            record["media"] = "|".join(m["media"] for m in record["media"])
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+def write_export(path, fmt, scheduled):
+    db = post_store.read_only()
+    try:
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            f.writelines(export_lines(fmt, db.execute("SELECT id, text FROM posts ORDER BY id"), scheduled))
+    finally:
+        db.close()
+
+def import_format(filename):
+    return "csv" if filename.lower().endswith(".csv") else "jsonl"
+
+# === Состояния диалогов ===
+# Многошаговые сценарии хранятся как состояние пользователя в FSM-хранилище,
+# а не как обработчики, регистрируемые на лету.
+FSM_IDLE_TIMEOUT = 15 * 60  # секунды без сообщений до сброса сценария
+
+class AddPost(StatesGroup):
+    text = State()
+
+class EditPost(StatesGroup):
+    text = State()
+
+class SchedulePost(StatesGroup):
+    datetime = State()
+    content = State()
+
+class EditScheduled(StatesGroup):
+    content = State()
+
+class ChangeDate(StatesGroup):
+    datetime = State()
+
+class ImportPosts(StatesGroup):
+    file = State()
+
+class SearchPosts(StatesGroup):
+    query = State()
+
+MENU_BUTTONS = {button.text for row in main_kb.keyboard for button in row}
+
+def not_menu_button(msg: types.Message):
+    # Кнопка меню посреди сценария начинает новый сценарий, а не считается ответом
+    return msg.text not in MENU_BUTTONS
+
+class ActivityMiddleware(BaseMiddleware):
+    # Сценарии есть только у администратора — апдейты остальных пользователей
+    # не стоят записи в posts.db
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        if message.from_user and message.from_user.id == ADMIN_ID:
+            await fsm_storage.touch(message.chat.id, message.from_user.id)
+
+    async def on_pre_process_callback_query(self, callback: types.CallbackQuery, data: dict):
+        if callback.message and callback.from_user.id == ADMIN_ID:
+            await fsm_storage.touch(callback.message.chat.id, callback.from_user.id)
+
+dp.middleware.setup(ActivityMiddleware())
+
+class MetricsMiddleware(BaseMiddleware):
+    # process_* вызывается после фильтров, когда хендлер уже выбран
+    async def _started(self, data):
+        data["metrics_handler"] = current_handler.get().__name__
+        data["metrics_started"] = time.monotonic()
+
+    async def _finished(self, data):
+        if "metrics_started" in data:
+            HANDLER_LATENCY.labels(data["metrics_handler"]).observe(time.monotonic() - data["metrics_started"])
+
+    async def on_process_message(self, message, data):
+        await self._started(data)
+
+    async def on_post_process_message(self, message, results, data):
+        await self._finished(data)
+
+    async def on_process_callback_query(self, callback, data):
+        await self._started(data)
+
+    async def on_post_process_callback_query(self, callback, results, data):
+        await self._finished(data)
+
+    async def on_process_channel_post(self, message, data):
+        await self._started(data)
+
+    async def on_post_process_channel_post(self, message, results, data):
+        await self._finished(data)
+
+dp.middleware.setup(MetricsMiddleware())
+
+async def expire_idle_states():
+    # Сценарии общие для всех копий — сбрасывает их одна, ведущая
+    if not publisher.active:
+        return
+    for chat_id, unfinished in await fsm_storage.expire(time.time() - FSM_IDLE_TIMEOUT):
+        if unfinished:
+            await bot.send_message(chat_id, "⌛ Действие отменено: долго не было ответа.")
+
+async def build_post(msg: types.Message, scheduled):
+    # Пост из сообщения администратора; None — если сообщение не даёт поста
+    if msg.content_type == ContentType.TEXT:
+        text = msg.text.strip()
+        if text.startswith("http"):
+            image = await fetch_image(text)
+            if not image:
+                await msg.answer("⚠️ Не удалось загрузить изображение по ссылке.")
+                return None
+            return photo_file_post(scheduled, text, image)
+        return {"datetime": scheduled, "type": "text", "text": text}
+    if msg.media_group_id:
+        # Альбом собирает первое сообщение группы, остальные просто добавляются
+        messages = await media_groups.add(msg)
+        if messages is None:
+            return None
+        photos = [m for m in messages if m.photo]
+        if len(photos) < len(messages):
+            await msg.answer("⚠️ В альбоме поддерживаются только фото, остальное пропущено.")
+        if not photos:
+            return None
+        return {
+            "datetime": scheduled,
+            "type": "album",
+            "media": [{"type": "photo", "media": m.photo[-1].file_id, "caption": m.caption or ""} for m in photos]
+        }
+    if msg.content_type == ContentType.PHOTO:
+        return {
+            "datetime": scheduled,
+            "type": "photo",
+            "file_id": msg.photo[-1].file_id,
+            "caption": msg.caption or ""
+        }
+    await msg.answer("⚠️ Тип контента не поддерживается.")
+    return None
+
+MEDIA_GROUP_DEBOUNCE = 1.0   # секунды тишины, после которых альбом считается полным
+MEDIA_GROUP_MAX_ITEMS = 10   # больше Telegram в один альбом не принимает
+
+class MediaGroupCollector:
+    # Сообщения альбома приходят отдельными апдейтами, и балансировщик может
+    # раздать их разным копиям бота, поэтому куски складываются в posts.db.
+    # Альбом собирает копия, первой записавшая группу: она ждёт, пока группа
+    # затихнет на debounce секунд, и читает куски из базы. Остальные копии
+    # только добавляют свой кусок и сразу освобождают хендлер.
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS media_groups (
+            group_id TEXT PRIMARY KEY,
+            last_part_at REAL NOT NULL,
+            emitted INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS media_group_parts (
+            group_id TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            PRIMARY KEY (group_id, message_id)
+        );
+    """
+    EMITTED_TTL = 3600  # секунды, сколько помнить собранные группы, чтобы опоздавшие куски не стали вторым альбомом
+
+    def __init__(self, path, debounce=MEDIA_GROUP_DEBOUNCE, max_items=MEDIA_GROUP_MAX_ITEMS):
+        self.path = path
+        self.debounce = debounce
+        self.max_items = max_items
+        self.db = None
+
+    def open(self):
+        # Как и SQLiteStorage, ходит в базу только из потока storage_executor
+        self.db = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        with self.db:
+            self.db.executescript(self.SCHEMA)
+
+    def _record(self, group_id, message_id, message):
+        # (первый ли это кусок группы, принят ли кусок)
+        with self.db:
+            first = self.db.execute(
+                "INSERT OR IGNORE INTO media_groups (group_id, last_part_at) VALUES (?, ?)", (group_id, time.time())
+            ).rowcount > 0
+            if not first and not self.db.execute(
+                "UPDATE media_groups SET last_part_at = ? WHERE group_id = ? AND NOT emitted", (time.time(), group_id)
+            ).rowcount:
+                return False, False
+            self.db.execute(
+                "INSERT OR IGNORE INTO media_group_parts (group_id, message_id, message) VALUES (?, ?, ?)",
+                (group_id, message_id, message)
+            )
+        return first, True
+
+    def _status(self, group_id):
+        return self.db.execute(
+            "SELECT last_part_at, (SELECT count(*) FROM media_group_parts p WHERE p.group_id = g.group_id) "
+            "FROM media_groups g WHERE group_id = ?", (group_id,)
+        ).fetchone()
+
+    async def add(self, msg):
+        # Список сообщений альбома по порядку, если его собирает этот вызов, иначе None
+        group_id = msg.media_group_id
+        first, accepted = await run_io("albums", self._record, group_id, msg.message_id, msg.as_json())
+        if not accepted:
+            logging.warning(f"[ALBUM] Сообщение {msg.message_id} пришло после сборки альбома {group_id}, пропущено")
+        if not first:
+            return None
+        while True:
+            last_part_at, parts = await run_io("albums", self._status, group_id)
+            wait = last_part_at + self.debounce - time.time()
+            if wait <= 0 or parts >= self.max_items:
+                break
+            await asyncio.sleep(wait)
+        rows = await run_io("albums", self._emit, group_id)
+        # Апдейты могут обрабатываться не по порядку — порядок фото берём из message_id
+        return [types.Message.to_object(json.loads(message)) for message, in rows[:self.max_items]]
+
+    def _emit(self, group_id):
+        with self.db:
+            self.db.execute("UPDATE media_groups SET emitted = 1 WHERE group_id = ?", (group_id,))
+            rows = self.db.execute(
+                "SELECT message FROM media_group_parts WHERE group_id = ? ORDER BY message_id", (group_id,)
+            ).fetchall()
+            # Куски собранных групп больше не нужны, сами группы помним EMITTED_TTL
+            self.db.execute("DELETE FROM media_group_parts WHERE group_id = ?", (group_id,))
+            self.db.execute(
+                "DELETE FROM media_groups WHERE emitted AND last_part_at < ?", (time.time() - self.EMITTED_TTL,)
+            )
+        return rows
+
+media_groups = MediaGroupCollector(POSTS_DB_FILE)
+
+# === Превью и постраничные списки ===
+PAGE_SIZE = 10
+PREVIEW_WIDTH = 80
+
+def render_preview(post, width=PREVIEW_WIDTH):
+    if post["type"] == "text":
+        return post["text"].replace("\n", " ")[:width]
+    if post["type"] == "album":
+        return f"[Альбом из {len(post['media'])} фото]"
+    label = "[Фото по ссылке]" if post["type"] == "photo_file" or post.get("url") else "[Фото]"
+    return f"{label} {post.get('caption', '').replace(chr(10), ' ')[:width]}"
+
+class PreviewIndex:
+    # Строки превью запланированных постов в порядке времени публикации.
+    # Обновляется по одному посту при каждом изменении расписания, так что
+    # открыть страницу — это срез списка, а не перерисовка всех постов.
+
+    def __init__(self):
+        self.keys = []   # отсортированные (datetime, id)
+        self.lines = {}  # id → (ключ, строка превью)
+
+    def update(self, post_id, post):
+        old = self.lines.pop(post_id, None)
+        if old is not None:
+            del self.keys[bisect.bisect_left(self.keys, old[0])]
+        if post is not None:
+            key = (post["datetime"], post_id)
+            bisect.insort(self.keys, key)
+            self.lines[post_id] = (key, self._line(post))
+
+    def rebuild(self, posts):
+        # Всё расписание сразу: одна сортировка вместо insort на каждый пост
+        self.lines = {post_id: ((post["datetime"], post_id), self._line(post)) for post_id, post in posts.items()}
+        self.keys = sorted(key for key, _ in self.lines.values())
+
+    def _line(self, post):
+        return f"🗓 {post['datetime']}\n{render_preview(post)}"
+
+    def __len__(self):
+        return len(self.keys)
+
+    def pages(self):
+        return max(1, -(-len(self.keys) // PAGE_SIZE))
+
+    def page(self, page):
+        start = page * PAGE_SIZE
+        return [(start + i + 1, post_id, self.lines[post_id][1])
+                for i, (_, post_id) in enumerate(self.keys[start:start + PAGE_SIZE])]
+
+schedule_previews = PreviewIndex()
+schedule.listeners.append(schedule_previews.update)
+schedule.rebuilders[schedule_previews.update] = schedule_previews.rebuild
+
+SCHEDULE_VIEWS = {
+    "view": "📅 Запланированные посты:",
+    "del": "🗑 Выберите пост для удаления:",
+    "edit": "✏️ Выберите пост для редактирования:",
+    "date": "📆 Выберите пост, для которого хотите изменить дату:"
+}
+
+LIBRARY_VIEWS = {
+    "view": "📋 Список постов:",
+    "del": "🗑 Выберите пост для удаления:",
+    "edit": "✏️ Выберите пост для редактирования:"
+}
+
+def schedule_page(mode, page):
+    pages = schedule_previews.pages()
+    page = min(max(page, 0), pages - 1)
+    items = schedule_previews.page(page)
+    text = SCHEDULE_VIEWS[mode] + "\n\n" + "".join(f"{n}. {line}\n\n" for n, _, line in items)
+
+    keyboard = InlineKeyboardMarkup(row_width=5)
+    if mode != "view":
+        keyboard.add(*[InlineKeyboardButton(str(n), callback_data=f"ssel:{mode}:{page}:{post_id}") for n, post_id, _ in items])
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"sch:{mode}:{page - 1}"))
+    if pages > 1:
+        nav.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="noop"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"sch:{mode}:{page + 1}"))
+    if nav:
+        keyboard.row(*nav)
+    return text, keyboard
+
+def library_page(mode, after_id=0, before_id=None):
+    rows = post_store.page(after_id, before_id, PAGE_SIZE)
+    if not rows and after_id:
+        # Страница опустела после удаления — показываем предыдущую
+        rows = post_store.page(before_id=after_id + 1, limit=PAGE_SIZE)
+    text = LIBRARY_VIEWS[mode] + "\n\n" + "".join(
+        "{}. {}...\n\n".format(row["id"], row["preview"].replace("\n", " ")) for row in rows
+    )
+
+    keyboard = InlineKeyboardMarkup(row_width=5)
+    if mode != "view" and rows:
+        first_id = rows[0]["id"]
+        keyboard.add(*[InlineKeyboardButton(str(row["id"]), callback_data=f"lsel:{mode}:{first_id}:{row['id']}") for row in rows])
+    nav = []
+    if rows and post_store.has_before(rows[0]["id"]):
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"lib:{mode}:b{rows[0]['id']}"))
+    if rows and post_store.has_after(rows[-1]["id"]):
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"lib:{mode}:a{rows[-1]['id']}"))
+    if nav:
+        keyboard.row(*nav)
+    return text, keyboard
+
+def dead_letters_page(page):
+    # После долгого простоя неотправленных может быть тысячи — одним
+    # сообщением они не влезут в лимит Telegram, а с ним пропадут и кнопки
+    letters = publisher.current_dead_letters()
+    pages = max(1, -(-len(letters) // PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    text = f"☠️ Неотправленные посты ({len(letters)}):\n\n"
+    for n, letter in enumerate(letters[page * PAGE_SIZE:(page + 1) * PAGE_SIZE], page * PAGE_SIZE + 1):
+        text += f"{n}. 🗓 {letter['post']['datetime']} → {letter['chat_id']}\n⚠️ {letter['error'][:100]}\n\n"
+
+    keyboard = InlineKeyboardMarkup()
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"dead:{page - 1}"))
+    if pages > 1:
+        nav.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="noop"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"dead:{page + 1}"))
+    if nav:
+        keyboard.row(*nav)
+    keyboard.row(
+        InlineKeyboardButton("🔁 Отправить снова", callback_data="dead_retry"),
+        InlineKeyboardButton("🧹 Очистить", callback_data="dead_clear")
+    )
+    return text, keyboard
+
+async def show_page(callback: types.CallbackQuery, text, keyboard):
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    except MessageNotModified:
+        pass
+
+# === Поиск по библиотеке и расписанию ===
+# Библиотеку индексирует SQLite (posts_fts, триггеры PostStore), расписание —
+# такой же FTS5-индекс в памяти, который слушатель расписания обновляет по
+# одному посту. Результаты обоих сливаются по рангу bm25.
+
+def search_query(text):
+    # Запрос → выражение FTS5. Каждое слово ищется как префикс («париж»
+    # найдёт «Парижа»), слова через точку, дефис или двоеточие — как фраза,
+    # чтобы «15.04» и «2025-04-15 18:30» находили даты. Нужны все части.
+    terms = []
+    for chunk in normalize_text(text).split():
+        words = re.findall(r"\w+", chunk)
+        if words:
+            terms.append('"{}"*'.format(" ".join(words)))
+    return " ".join(terms) or None
+
+class ScheduleSearch:
+    # Индекс только для поиска: превью берутся из самих постов. Строки
+    # не удаляются сразу, а устаревают (как записи кучи в ScheduledPosts):
+    # FTS5 сбрасывает индекс на диск — здесь в память — при каждом удалении
+    # не по порядку rowid, а правки и публикации идут вразнобой. Устаревшие
+    # строки пропускаются при поиске и удаляются пачкой по возрастанию rowid.
+
+    def __init__(self):
+        # Транзакция не фиксируется никогда: база в памяти, а FTS5 на каждом
+        # коммите тоже сбрасывает новый сегмент индекса
+        self.db = sqlite3.connect(":memory:")
+        self._create()
+        self.rowids = {}  # id поста → актуальная строка индекса
+        self.stale = []   # строки, которые пора удалить
+
+    def _create(self):
+        self.db.execute(f"CREATE VIRTUAL TABLE scheduled_fts USING fts5(post_id UNINDEXED, text, date, tokenize = '{SEARCH_TOKENIZER}')")
+
+    def _row(self, post_id, post):
+        texts = [post_text(post)] + [post_text({**post, **variant}) for variant in post.get("variants", {}).values()]
+        # «2025-04-15 18:30» → ещё и «15.04.2025», как в библиотеке
+        when = post["datetime"]
+        return post_id, "\n".join(texts).replace("ё", "е").replace("Ё", "Е"), f"{when} {when[8:10]}.{when[5:7]}.{when[:4]}"
+
+    def update(self, post_id, post):
+        rowid = self.rowids.pop(post_id, None)
+        if rowid is not None:
+            self.stale.append(rowid)
+        if post is not None:
+            cur = self.db.execute("INSERT INTO scheduled_fts (post_id, text, date) VALUES (?, ?, ?)", self._row(post_id, post))
+            self.rowids[post_id] = cur.lastrowid
+        if len(self.stale) > len(self.rowids) + 64:
+            self.db.executemany("DELETE FROM scheduled_fts WHERE rowid = ?", ((r,) for r in sorted(self.stale)))
+            self.stale = []
+
+    def rebuild(self, posts):
+        # Всё расписание сразу: таблица создаётся заново и заполняется одним
+        # executemany, строки нумеруются подряд с 1
+        self.db.execute("DROP TABLE scheduled_fts")
+        self._create()
+        self.rowids = {post_id: rowid for rowid, post_id in enumerate(posts, 1)}
+        self.stale = []
+        self.db.executemany(
+            "INSERT INTO scheduled_fts (rowid, post_id, text, date) VALUES (?, ?, ?, ?)",
+            ((self.rowids[post_id], *self._row(post_id, post)) for post_id, post in posts.items())
+        )
+
+    def search(self, match, limit):
+        hits = []
+        for rowid, post_id, rank in self.db.execute(
+            "SELECT rowid, post_id, rank FROM scheduled_fts WHERE scheduled_fts MATCH ? ORDER BY rank", (match,)
+        ):
+            if self.rowids.get(post_id) == rowid:
+                hits.append((post_id, rank))
+                if len(hits) == limit:
+                    break
+        return hits
+
+schedule_search = ScheduleSearch()
+schedule.listeners.append(schedule_search.update)
+schedule.rebuilders[schedule_search.update] = schedule_search.rebuild
+
+def find_posts(query, limit):
+    # Лучшие limit совпадений из библиотеки и расписания вместе
+    match = search_query(query)
+    if match is None:
+        return []
+    hits = [
+        {"kind": "library", "id": row["id"], "preview": row["preview"].replace("\n", " "), "rank": row["rank"]}
+        for row in post_store.search(match, limit, PREVIEW_WIDTH)
+    ]
+    for post_id, rank in schedule_search.search(match, limit):
+        post = schedule.get(post_id)
+        if post is not None:
+            hits.append({"kind": "schedule", "id": post_id, "datetime": post["datetime"], "preview": render_preview(post), "rank": rank})
+    hits.sort(key=lambda hit: hit["rank"])
+    return hits[:limit]
+
+def search_page(query, page):
+    # Страница N — это срез лучших (N + 1) * PAGE_SIZE + 1 совпадений:
+    # лишнее совпадение показывает, есть ли следующая страница
+    page = max(page, 0)
+    hits = find_posts(query, (page + 1) * PAGE_SIZE + 1)
+    items = hits[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]
+    if not items:
+        return f"🔍 По запросу «{query}» ничего не найдено.", None
+
+    lines = []
+    for n, hit in enumerate(items, page * PAGE_SIZE + 1):
+        where = f"📋 №{hit['id']}" if hit["kind"] == "library" else f"🗓 {hit['datetime']}"
+        lines.append(f"{n}. {where}\n{hit['preview']}\n\n")
+    text = f"🔍 Результаты по запросу «{query}»:\n\n" + "".join(lines)
+
+    keyboard = InlineKeyboardMarkup()
+    has_next = len(hits) > (page + 1) * PAGE_SIZE
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"find:{page - 1}"))
+    if page > 0 or has_next:
+        nav.append(InlineKeyboardButton(str(page + 1), callback_data="noop"))
+    if has_next:
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"find:{page + 1}"))
+    if nav:
+        keyboard.row(*nav)
+    return text, keyboard
+
 # Кнопки предпросмотра
 def get_preview_keyboard():
     keyboard = InlineKeyboardMarkup()
@@ -123,439 +2669,596 @@ def get_preview_keyboard():
     )
     return keyboard
     
-@dp.message_handler(commands=["start"])
-async def start(message: types.Message):
+@dp.message_handler(commands=["start"], state="*")
+async def start(message: types.Message, state: FSMContext):
     if message.from_user.id != ADMIN_ID:
         return await message.answer("⛔ Доступ запрещён.")
+    await state.finish()
     await message.answer("Добро пожаловать в панель управления ботом!", reply_markup=main_kb)
 
-@dp.message_handler(lambda msg: msg.text == "📋 Список постов")
-async def list_posts(message: types.Message):
-    posts = load_posts()
-    if not posts:
+@dp.message_handler(commands=["cancel"], state="*", user_id=ADMIN_ID)
+async def cancel(message: types.Message, state: FSMContext):
+    await state.finish()
+    await fsm_storage.pop_preview(message.from_user.id)
+    await message.answer("❌ Действие отменено.", reply_markup=main_kb)
+
+@dp.message_handler(commands=["search"], state="*", user_id=ADMIN_ID)
+async def search_command(message: types.Message, state: FSMContext):
+    # /search слова — сразу результаты; без слов — как кнопка «🔍 Поиск»
+    query = message.get_args().strip()
+    if not query:
+        return await search_prompt(message, state)
+    await state.finish()
+    await show_search(message, state, query)
+
+@dp.message_handler(lambda msg: msg.text == "📋 Список постов", state="*", user_id=ADMIN_ID)
+async def list_posts(message: types.Message, state: FSMContext):
+    await state.finish()
+    if not post_store.count():
         return await message.answer("❌ Постов пока нет.")
-    text = ""
-    for i, p in enumerate(posts):
-        preview = p.replace('\n', ' ')[:100]
-        text += "{}. {}...\n\n".format(i + 1, preview)
-    await message.answer("📋 Список постов:\n\n{}".format(text))
-
-@dp.message_handler(lambda msg: msg.text == "🆕 Добавить пост")
-async def add_post_prompt(message: types.Message):
+    text, keyboard = library_page("view")
+    await message.answer(text, reply_markup=keyboard)
+
+@dp.callback_query_handler(lambda c: c.data.startswith("lib:"), state="*", user_id=ADMIN_ID)
+async def library_page_callback(callback: types.CallbackQuery):
+    _, mode, cursor = callback.data.split(":")
+    if cursor.startswith("b"):
+        text, keyboard = library_page(mode, before_id=int(cursor[1:]))
+    else:
+        text, keyboard = library_page(mode, after_id=int(cursor[1:]))
+    await show_page(callback, text, keyboard)
+    await callback.answer()
+
+@dp.callback_query_handler(lambda c: c.data.startswith("lsel:"), state="*", user_id=ADMIN_ID)
+async def library_select_callback(callback: types.CallbackQuery, state: FSMContext):
+    _, mode, first_id, post_id = callback.data.split(":")
+    post_id = int(post_id)
+    if post_store.get(post_id) is None:
+        return await callback.answer("❌ Пост уже удалён.", show_alert=True)
+
+    if mode == "del":
+        deleted = post_store.delete(post_id)
+        logging.info(f"[POST DELETED] Пользователь {callback.from_user.id} удалил пост №{post_id}")
+        await callback.message.answer("🗑 Удалён пост:\n\n{}...".format(deleted["text"][:100]))
+        text, keyboard = library_page(mode, after_id=int(first_id) - 1)
+        await show_page(callback, text, keyboard)
+    elif mode == "edit":
+        await state.finish()
+        await state.set_state(EditPost.text)
+        await state.update_data(post_id=post_id)
+        await callback.message.answer("Введите новый текст для поста №{}:".format(post_id))
+    await callback.answer()
+
+@dp.callback_query_handler(lambda c: c.data == "noop", state="*")
+async def noop_callback(callback: types.CallbackQuery):
+    await callback.answer()
+
+@dp.message_handler(lambda msg: msg.text == "🆕 Добавить пост", state="*", user_id=ADMIN_ID)
+async def add_post_prompt(message: types.Message, state: FSMContext):
+    await state.finish()
+    await AddPost.text.set()
     await message.answer("✏️ Введите новый пост. Как закончите — отправьте его в одном сообщении.")
 
-    @dp.message_handler()
-    async def receive_new_post(msg: types.Message):
-        if msg.from_user.id != ADMIN_ID:
-            return
-        posts = load_posts()
-        posts.append(msg.text.strip())
-        save_posts(posts)
-        await msg.answer("✅ Пост добавлен!")
-        logging.info(f"[POST ADDED] Пользователь {msg.from_user.id} добавил обычный пост.")
-        dp.message_handlers.unregister(receive_new_post)
-
-@dp.message_handler(lambda msg: msg.text == "🗑 Удалить пост")
-async def delete_post_prompt(message: types.Message):
-    await message.answer("Введите номер поста, который хотите удалить.")
-
-    @dp.message_handler()
-    async def receive_delete_index(msg: types.Message):
-        if msg.from_user.id != ADMIN_ID:
-            return
-        try:
-            index = int(msg.text.strip()) - 1
-            posts = load_posts()
-            if 0 <= index < len(posts):
-                deleted = posts.pop(index)
-                save_posts(posts)
-                await msg.answer("🗑 Удалён пост:\n\n{}...".format(deleted[:100]))
-                logging.info(f"[POST DELETED] Пользователь {msg.from_user.id} удалил пост №{index + 1}")
-            else:
-                await msg.answer("❌ Неверный номер.")
-        except:
-            await msg.answer("⚠️ Введите корректный номер.")
-        dp.message_handlers.unregister(receive_delete_index)
+@dp.message_handler(not_menu_button, state=AddPost.text)
+async def receive_new_post(msg: types.Message, state: FSMContext):
+    post_id = post_store.add(msg.text.strip())
+    await state.finish()
+    await msg.answer("✅ Пост №{} добавлен!".format(post_id))
+    logging.info(f"[POST ADDED] Пользователь {msg.from_user.id} добавил обычный пост.")
+
+@dp.message_handler(lambda msg: msg.text == "🗑 Удалить пост", state="*", user_id=ADMIN_ID)
+async def delete_post_prompt(message: types.Message, state: FSMContext):
+    await state.finish()
+    if not post_store.count():
+        return await message.answer("❌ Постов пока нет.")
+    text, keyboard = library_page("del")
+    await message.answer(text, reply_markup=keyboard)
 
-@dp.message_handler(lambda msg: msg.text == "📊 Статистика")
-async def show_stats(message: types.Message):
-    posts = load_posts()
-    await message.answer(f"📊 Всего постов: {len(posts)}")
+@dp.message_handler(lambda msg: msg.text == "📊 Статистика", state="*", user_id=ADMIN_ID)
+async def show_stats(message: types.Message, state: FSMContext):
+    await state.finish()
+    await message.answer(f"📊 Всего постов: {post_store.count()}")
 
 # === ✏️ Редактирование поста ===
-@dp.message_handler(lambda msg: msg.text == "✏️ Редактировать пост")
-async def edit_post_prompt(message: types.Message):
-    await message.answer("Введите номер поста, который хотите отредактировать.")
-
-    @dp.message_handler()
-    async def receive_edit_index(msg: types.Message):
-        if msg.from_user.id != ADMIN_ID:
-            return
-        try:
-            index = int(msg.text.strip()) - 1
-            posts = load_posts()
-            if 0 <= index < len(posts):
-                await msg.answer("Введите новый текст для поста №{}:".format(index + 1))
-
-                @dp.message_handler()
-                async def receive_new_content(new_msg: types.Message):
-                    if new_msg.from_user.id != ADMIN_ID:
-                        return
-                    posts[index] = new_msg.text.strip()
-                    save_posts(posts)
-                    await new_msg.answer("✅ Пост №{} обновлён.".format(index + 1))
-                    dp.message_handlers.unregister(receive_new_content)
-
-                dp.message_handlers.unregister(receive_edit_index)
-            else:
-                await msg.answer("❌ Неверный номер поста.")
-                dp.message_handlers.unregister(receive_edit_index)
-        except:
-            await msg.answer("⚠️ Введите корректный номер.")
-            dp.message_handlers.unregister(receive_edit_index)
-
-@dp.message_handler(lambda msg: msg.text == "⏰ Запланировать пост")
-async def schedule_post_prompt(message: types.Message):
+@dp.message_handler(lambda msg: msg.text == "✏️ Редактировать пост", state="*", user_id=ADMIN_ID)
+async def edit_post_prompt(message: types.Message, state: FSMContext):
+    await state.finish()
+    if not post_store.count():
+        return await message.answer("❌ Постов пока нет.")
+    text, keyboard = library_page("edit")
+    await message.answer(text, reply_markup=keyboard)
+
+@dp.message_handler(not_menu_button, state=EditPost.text)
+async def receive_new_content(new_msg: types.Message, state: FSMContext):
+    post_id = (await state.get_data())["post_id"]
+    await state.finish()
+    post_store.update(post_id, new_msg.text.strip())
+    await new_msg.answer("✅ Пост №{} обновлён.".format(post_id))
+
+@dp.message_handler(lambda msg: msg.text == "⏰ Запланировать пост", state="*", user_id=ADMIN_ID)
+async def schedule_post_prompt(message: types.Message, state: FSMContext):
+    await state.finish()
+    await SchedulePost.datetime.set()
     await message.answer("Введите дату и время публикации (в формате ГГГГ-ММ-ДД ЧЧ:ММ):")
 
-    @dp.message_handler()
-    async def receive_datetime(msg: types.Message):
-        if msg.from_user.id != ADMIN_ID:
-            return
-        try:
-            scheduled_str = msg.text.strip()
-            scheduled_time = datetime.strptime(scheduled_str, "%Y-%m-%d %H:%M")
+@dp.message_handler(not_menu_button, state=SchedulePost.datetime)
+async def receive_datetime(msg: types.Message, state: FSMContext):
+    try:
+        scheduled_time = datetime.strptime((msg.text or "").strip(), DATETIME_FORMAT)
+    except ValueError:
+        await state.finish()
+        return await msg.answer("⚠️ Неверный формат даты и времени. Используй формат: `2025-04-15 18:30`", parse_mode=ParseMode.MARKDOWN)
+
+    if scheduled_time <= datetime.now():
+        await state.finish()
+        return await msg.answer("⚠️ Указанное время уже прошло. Пожалуйста, укажи время в будущем.")
+
+    await state.update_data(datetime=scheduled_time.strftime(DATETIME_FORMAT))
+    await SchedulePost.content.set()
+    await msg.answer("Теперь отправьте пост: это может быть текст, фото или альбом из фото с подписью.")
+
+@dp.message_handler(not_menu_button, state=SchedulePost.content, content_types=ContentType.ANY)
+async def receive_post(msg: types.Message, state: FSMContext):
+    data = await state.get_data()
+    post = await build_post(msg, data["datetime"])
+    if post is None:
+        return
+    try:
+        render_post(post)
+    except MarkdownError as e:
+        return await msg.answer(f"⚠️ Ошибка разметки: {e}. Отправьте пост ещё раз.")
+    await state.finish()
 
-            if scheduled_time <= datetime.now():
-                await msg.answer("⚠️ Указанное время уже прошло. Пожалуйста, укажи время в будущем.")
-                dp.message_handlers.unregister(receive_datetime)
-                return
+    await fsm_storage.set_preview(msg.from_user.id, post)
 
-            await msg.answer("Теперь отправьте пост: это может быть текст, фото или альбом из фото с подписью.")
-
-            album = []
-
-            @dp.message_handler(content_types=ContentType.ANY)
-            async def receive_post(msg: types.Message):
-                if msg.from_user.id != ADMIN_ID:
-                    return
-
-                if msg.content_type == ContentType.TEXT:
-                    post = {
-                        "datetime": scheduled_time.strftime("%Y-%m-%d %H:%M"),
-                        "type": "text",
-                        "text": msg.text.strip()
-                    }
-                elif msg.text.strip().startswith("http"):
-                    img_path = await download_image_from_url(msg.text.strip())
-                    if img_path:
-                        post = {
-                            "datetime": scheduled_time.strftime("%Y-%m-%d %H:%M"),
-                            "type": "photo_file",
-                            "path": img_path,
-                            "caption": ""
-                        }
-                    else:
-                        await msg.answer("⚠️ Не удалось загрузить изображение по ссылке.")
-                        return
-                elif msg.content_type == ContentType.PHOTO:
-                    post = {
-                        "datetime": scheduled_time.strftime("%Y-%m-%d %H:%M"),
-                        "type": "photo",
-                        "file_id": msg.photo[-1].file_id,
-                        "caption": msg.caption or ""
-                    }
-                elif msg.media_group_id:
-                    album.append(msg)
-                    await asyncio.sleep(1.5)
-                    if not album or msg.media_group_id != album[0].media_group_id:
-                        return
-                    post = {
-                        "datetime": scheduled_time.strftime("%Y-%m-%d %H:%M"),
-                        "type": "album",
-                        "media": [{"type": "photo", "media": m.photo[-1].file_id, "caption": m.caption or ""} for m in album]
-                    }
-                else:
-                    await msg.answer("⚠️ Тип контента не поддерживается.")
-                    return
-
-                pending_posts[msg.from_user.id] = post
-
-                if post["type"] == "text":
-                    await msg.answer(post["text"], parse_mode=ParseMode.MARKDOWN, reply_markup=get_preview_keyboard())
-                elif post["type"] == "photo":
-                    await bot.send_photo(msg.chat.id, post["file_id"], caption=post.get("caption", ""), parse_mode=ParseMode.MARKDOWN, reply_markup=get_preview_keyboard())
-                elif post["type"] == "photo_file":
-                    photo = InputFile(post["path"])
-                    await bot.send_photo(msg.chat.id, photo, caption=post.get("caption", ""), parse_mode=ParseMode.MARKDOWN, reply_markup=get_preview_keyboard())
-                elif post["type"] == "album":
-                    await msg.answer("📷 Для альбомов предпросмотр пока не поддерживается. Сохраняю автоматически.")
-                    posts = load_scheduled_posts()
-                    posts.append(post)
-                    save_scheduled_posts(posts)
-
-            dp.message_handlers.unregister(receive_datetime)
-
-        except ValueError:
-            await msg.answer("⚠️ Неверный формат даты и времени. Используй формат: `2025-04-15 18:30`", parse_mode=ParseMode.MARKDOWN)
-            dp.message_handlers.unregister(receive_datetime)
-
-            dp.message_handlers.unregister(receive_datetime)
-        except:
-            await msg.answer("⚠️ Неверный формат. Используй: 2025-04-10 12:00")
-            dp.message_handlers.unregister(receive_datetime)
-
-@dp.callback_query_handler(lambda c: c.data in ["confirm_post", "cancel_post"])
+    duplicate = duplicates.find(post_text(post))
+    if duplicate:
+        await msg.answer(f"⚠️ Похожий пост уже есть: {duplicate}")
+
+    if post["type"] != "album":
+        await send_post(msg.chat.id, post, reply_markup=get_preview_keyboard())
+    else:
+        # К альбому нельзя прикрепить кнопки — они идут отдельным сообщением
+        await send_post(msg.chat.id, post)
+        await msg.answer(f"📷 Альбом из {len(post['media'])} фото — запланировать?", reply_markup=get_preview_keyboard())
+
+@dp.callback_query_handler(lambda c: c.data in ["confirm_post", "cancel_post"], state="*")
 async def handle_preview_callback(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     if user_id != ADMIN_ID:
         return await callback.answer("⛔ Нет доступа", show_alert=True)
 
     if callback.data == "confirm_post":
-        if user_id in pending_posts:
-            post = pending_posts.pop(user_id)
-            posts = load_scheduled_posts()
-            posts.append(post)
-            save_scheduled_posts(posts)
-            await callback.message.answer(f"✅ Пост запланирован на {post['datetime']}")
-            logging.info(f"[POST SCHEDULED] Пользователь {user_id} запланировал пост на {post['datetime']}")
+        post = await fsm_storage.get_preview(user_id)
+        if post is None:
+            await callback.message.answer("⌛ Предпросмотр устарел — отправьте пост заново.")
+            return await callback.message.delete()
+        try:
+            staged = await stage_post(post)
+        except ValueError as e:
+            await fsm_storage.pop_preview(user_id)
+            await callback.message.answer(f"⚠️ Ошибка разметки: {e}. Пост не запланирован.")
+            return await callback.message.delete()
+        except (TelegramAPIError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Предпросмотр остаётся — можно нажать ✅ ещё раз
+            logging.warning(f"[STAGING ERROR] {e}")
+            await callback.message.answer(f"⚠️ Не удалось подготовить пост: {e}. Попробуйте ещё раз.")
+            return await callback.answer()
+        # Предпросмотр забирает тот, кто первым закончил подготовку: второе
+        # нажатие (в том числе в другой копии бота) пост не задвоит
+        if await fsm_storage.pop_preview(user_id) is not None:
+            schedule.add(staged)
+            channels = f" в {', '.join(staged['targets'])}" if len(staged["targets"]) > 1 else ""
+            await callback.message.answer(f"✅ Пост запланирован на {staged['datetime']}{channels}")
+            logging.info(f"[POST SCHEDULED] Пользователь {user_id} запланировал пост на {staged['datetime']}")
         await callback.message.delete()
     elif callback.data == "cancel_post":
-        pending_posts.pop(user_id, None)
+        await fsm_storage.pop_preview(user_id)
         await callback.message.answer("❌ Пост отменён.")
         await callback.message.delete()
 
-@dp.message_handler(lambda msg: msg.text == "📅 Расписание")
-async def show_schedule(message: types.Message):
-    posts = load_scheduled_posts()
-    if not posts:
+@dp.message_handler(lambda msg: msg.text == "📅 Расписание", state="*", user_id=ADMIN_ID)
+async def show_schedule(message: types.Message, state: FSMContext):
+    await state.finish()
+    if not len(schedule_previews):
         return await message.answer("📭 Запланированных постов нет.")
-
-    text = ""
-    for i, post in enumerate(posts):
-        dt = post["datetime"]
-        preview = ""
-        if post["type"] == "text":
-            preview = post["text"][:80]
-        elif post["type"] == "photo":
-            preview = f"[Фото] {post.get('caption', '')[:80]}"
-        elif post["type"] == "photo_file":
-            preview = f"[Фото по ссылке] {post.get('caption', '')[:80]}"
-        elif post["type"] == "album":
-            preview = f"[Альбом из {len(post['media'])} фото]"
-
-        text += f"{i+1}. 🗓 {dt}\n{preview}\n\n"
-
-    await message.answer("📅 Запланированные посты:\n\n" + text)
-
-@dp.message_handler(lambda msg: msg.text == "🗑 Удалить запланированный")
-async def delete_scheduled_prompt(message: types.Message):
-    posts = load_scheduled_posts()
-    if not posts:
+    text, keyboard = schedule_page("view", 0)
+    await message.answer(text, reply_markup=keyboard)
+
+@dp.callback_query_handler(lambda c: c.data.startswith("sch:"), state="*", user_id=ADMIN_ID)
+async def schedule_page_callback(callback: types.CallbackQuery):
+    _, mode, page = callback.data.split(":")
+    text, keyboard = schedule_page(mode, int(page))
+    await show_page(callback, text, keyboard)
+    await callback.answer()
+
+@dp.callback_query_handler(lambda c: c.data.startswith("ssel:"), state="*", user_id=ADMIN_ID)
+async def schedule_select_callback(callback: types.CallbackQuery, state: FSMContext):
+    _, mode, page, post_id = callback.data.split(":")
+    if schedule.get(post_id) is None:
+        return await callback.answer("❌ Пост уже опубликован или удалён.", show_alert=True)
+
+    if mode == "del":
+        deleted = schedule.remove(post_id)
+        duplicates.remove(post_id)
+        await callback.message.answer(f"🗑 Удалён пост на {deleted['datetime']}")
+        if len(schedule_previews):
+            text, keyboard = schedule_page(mode, int(page))
+            await show_page(callback, text, keyboard)
+        else:
+            await callback.message.delete()
+    elif mode == "edit":
+        await state.finish()
+        await state.set_state(EditScheduled.content)
+        await state.update_data(post_id=post_id)
+        await callback.message.answer("Отправьте новый пост. Это может быть текст, фото, альбом или ссылка на изображение.")
+    elif mode == "date":
+        await state.finish()
+        await state.set_state(ChangeDate.datetime)
+        await state.update_data(post_id=post_id)
+        await callback.message.answer("Введите новую дату и время в формате: `2025-04-15 18:30`", parse_mode=ParseMode.MARKDOWN)
+    await callback.answer()
+
+@dp.message_handler(lambda msg: msg.text == "🗑 Удалить запланированный", state="*", user_id=ADMIN_ID)
+async def delete_scheduled_prompt(message: types.Message, state: FSMContext):
+    await state.finish()
+    if not len(schedule_previews):
         return await message.answer("📭 Нет запланированных постов для удаления.")
+    text, keyboard = schedule_page("del", 0)
+    await message.answer(text, reply_markup=keyboard)
 
-    # Показываем список с номерами
-    text = ""
-    for i, post in enumerate(posts):
-        dt = post["datetime"]
-        preview = ""
-        if post["type"] == "text":
-            preview = post["text"][:60]
-        elif post["type"] == "photo":
-            preview = f"[Фото] {post.get('caption', '')[:60]}"
-        elif post["type"] == "photo_file":
-            preview = f"[Фото по ссылке] {post.get('caption', '')[:60]}"
-        elif post["type"] == "album":
-            preview = f"[Альбом из {len(post['media'])} фото]"
-        text += f"{i + 1}. 🗓 {dt}\n{preview}\n\n"
-
-    await message.answer("📅 Запланированные посты:\n\n" + text)
-    await message.answer("Введите номер поста, который хотите удалить:")
-
-    @dp.message_handler()
-    async def receive_delete_index(msg: types.Message):
-        if msg.from_user.id != ADMIN_ID:
-            return
-        try:
-            index = int(msg.text.strip()) - 1
-            if 0 <= index < len(posts):
-                deleted = posts.pop(index)
-                save_scheduled_posts(posts)
-                await msg.answer(f"🗑 Удалён пост на {deleted['datetime']}")
-            else:
-                await msg.answer("❌ Неверный номер.")
-        except:
-            await msg.answer("⚠️ Введите корректный номер.")
-        dp.message_handlers.unregister(receive_delete_index)
-
-@dp.message_handler(lambda msg: msg.text == "✏️ Редактировать запланированный")
-async def edit_scheduled_prompt(message: types.Message):
-    posts = load_scheduled_posts()
-    if not posts:
+@dp.message_handler(lambda msg: msg.text == "✏️ Редактировать запланированный", state="*", user_id=ADMIN_ID)
+async def edit_scheduled_prompt(message: types.Message, state: FSMContext):
+    await state.finish()
+    if not len(schedule_previews):
         return await message.answer("📭 Нет запланированных постов для редактирования.")
-
-    text = ""
-    for i, post in enumerate(posts):
-        dt = post["datetime"]
-        preview = ""
-        if post["type"] == "text":
-            preview = post["text"][:60]
-        elif post["type"] == "photo":
-            preview = f"[Фото] {post.get('caption', '')[:60]}"
-        elif post["type"] == "photo_file":
-            preview = f"[Фото по ссылке] {post.get('caption', '')[:60]}"
-        elif post["type"] == "album":
-            preview = f"[Альбом из {len(post['media'])} фото]"
-        text += f"{i + 1}. 🗓 {dt}\n{preview}\n\n"
-
-    await message.answer("📅 Запланированные посты:\n\n" + text)
-    await message.answer("Введите номер поста, который хотите отредактировать:")
-
-    @dp.message_handler()
-    async def receive_edit_index(msg: types.Message):
-        if msg.from_user.id != ADMIN_ID:
-            return
-
-        try:
-            index = int(msg.text.strip()) - 1
-            posts = load_scheduled_posts()
-            if 0 <= index < len(posts):
-                await msg.answer("Отправьте новый пост. Это может быть текст, фото, альбом или ссылка на изображение.")
-
-                @dp.message_handler(content_types=ContentType.ANY)
-                async def receive_new_post(msg: types.Message):
-                    new_post = None
-
-                    if msg.content_type == ContentType.TEXT:
-                        if msg.text.strip().startswith("http"):
-                            # Ссылка на изображение
-                            img_path = await download_image_from_url(msg.text.strip())
-                            if img_path:
-                                new_post = {
-                                    "datetime": posts[index]["datetime"],
-                                    "type": "photo_file",
-                                    "path": img_path,
-                                    "caption": ""
-                                }
-                            else:
-                                await msg.answer("⚠️ Не удалось загрузить изображение.")
-                                return
-                        else:
-                            new_post = {
-                                "datetime": posts[index]["datetime"],
-                                "type": "text",
-                                "text": msg.text.strip()
-                            }
-                    elif msg.content_type == ContentType.PHOTO:
-                        new_post = {
-                            "datetime": posts[index]["datetime"],
-                            "type": "photo",
-                            "file_id": msg.photo[-1].file_id,
-                            "caption": msg.caption or ""
-                        }
-                    elif msg.media_group_id:
-                        # Альбом
-                        album = [msg]
-                        await asyncio.sleep(1.5)  # немного подождать для других фото
-                        new_post = {
-                            "datetime": posts[index]["datetime"],
-                            "type": "album",
-                            "media": [{"type": "photo", "media": m.photo[-1].file_id, "caption": m.caption or ""} for m in album]
-                        }
-                    else:
-                        await msg.answer("⚠️ Неподдерживаемый тип поста.")
-                        return
-
-                    posts[index] = new_post
-                    save_scheduled_posts(posts)
-                    await msg.answer("✅ Пост обновлён.")
-                    dp.message_handlers.unregister(receive_new_post)
-
-                dp.message_handlers.unregister(receive_edit_index)
-            else:
-                await msg.answer("❌ Неверный номер.")
-                dp.message_handlers.unregister(receive_edit_index)
-        except:
-            await msg.answer("⚠️ Введите корректный номер.")
-            dp.message_handlers.unregister(receive_edit_index)
-
-@dp.message_handler(lambda msg: msg.text == "📆 Изменить дату поста")
-async def change_post_date(message: types.Message):
-    posts = load_scheduled_posts()
-    if not posts:
+    text, keyboard = schedule_page("edit", 0)
+    await message.answer(text, reply_markup=keyboard)
+
+@dp.message_handler(not_menu_button, state=EditScheduled.content, content_types=ContentType.ANY)
+async def receive_scheduled_new_post(msg: types.Message, state: FSMContext):
+    post_id = (await state.get_data())["post_id"]
+    old_post = schedule.get(post_id)
+    if old_post is None:
+        await state.finish()
+        return await msg.answer("❌ Пост уже опубликован или удалён.")
+
+    new_post = await build_post(msg, old_post["datetime"])
+    if new_post is None:
+        return
+    try:
+        new_post = await stage_post(new_post)
+    except ValueError as e:
+        return await msg.answer(f"⚠️ Ошибка разметки: {e}. Отправьте пост ещё раз.")
+    except (TelegramAPIError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.warning(f"[STAGING ERROR] {e}")
+        return await msg.answer(f"⚠️ Не удалось подготовить пост: {e}. Отправьте его ещё раз или нажмите /cancel.")
+    await state.finish()
+    schedule.replace(post_id, new_post)
+    await msg.answer("✅ Пост обновлён.")
+
+@dp.message_handler(lambda msg: msg.text == "📆 Изменить дату поста", state="*", user_id=ADMIN_ID)
+async def change_post_date(message: types.Message, state: FSMContext):
+    await state.finish()
+    if not len(schedule_previews):
         return await message.answer("📭 Запланированных постов нет.")
+    text, keyboard = schedule_page("date", 0)
+    await message.answer(text, reply_markup=keyboard)
 
-    text = ""
-    for i, post in enumerate(posts):
-        dt = post["datetime"]
-        preview = ""
-        if post["type"] == "text":
-            preview = post["text"][:60]
-        elif post["type"] == "photo":
-            preview = f"[Фото] {post.get('caption', '')[:60]}"
-        elif post["type"] == "photo_file":
-            preview = f"[Фото по ссылке] {post.get('caption', '')[:60]}"
-        elif post["type"] == "album":
-            preview = f"[Альбом из {len(post['media'])} фото]"
-        text += f"{i + 1}. 🗓 {dt}\n{preview}\n\n"
-
-    await message.answer("📅 Запланированные посты:\n\n" + text)
-    await message.answer("Введите номер поста, для которого хотите изменить дату:")
-
-    @dp.message_handler()
-    async def receive_post_number(msg: types.Message):
-        if msg.from_user.id != ADMIN_ID:
-            return
-        try:
-            index = int(msg.text.strip()) - 1
-            posts = load_scheduled_posts()
-            if 0 <= index < len(posts):
-                await msg.answer("Введите новую дату и время в формате: `2025-04-15 18:30`", parse_mode=ParseMode.MARKDOWN)
-
-                @dp.message_handler()
-                async def receive_new_datetime(new_msg: types.Message):
-                    if new_msg.from_user.id != ADMIN_ID:
-                        return
-                    try:
-                        new_dt = datetime.strptime(new_msg.text.strip(), "%Y-%m-%d %H:%M")
-                        if new_dt <= datetime.now():
-                            await new_msg.answer("⚠️ Дата должна быть в будущем.")
-                            return
-                        posts[index]["datetime"] = new_dt.strftime("%Y-%m-%d %H:%M")
-                        save_scheduled_posts(posts)
-                        await new_msg.answer("✅ Дата и время поста обновлены.")
-                        dp.message_handlers.unregister(receive_new_datetime)
-                    except:
-                        await new_msg.answer("⚠️ Неверный формат. Используйте: 2025-04-15 18:30")
-                dp.message_handlers.unregister(receive_post_number)
-            else:
-                await msg.answer("❌ Неверный номер поста.")
-                dp.message_handlers.unregister(receive_post_number)
-        except:
-            await msg.answer("⚠️ Введите корректный номер.")
-            dp.message_handlers.unregister(receive_post_number)
+@dp.message_handler(not_menu_button, state=ChangeDate.datetime)
+async def receive_new_datetime(new_msg: types.Message, state: FSMContext):
+    try:
+        new_dt = datetime.strptime((new_msg.text or "").strip(), DATETIME_FORMAT)
+    except ValueError:
+        return await new_msg.answer("⚠️ Неверный формат. Используйте: 2025-04-15 18:30")
+    if new_dt <= datetime.now():
+        return await new_msg.answer("⚠️ Дата должна быть в будущем.")
+
+    post_id = (await state.get_data())["post_id"]
+    await state.finish()
+    if schedule.get(post_id) is None:
+        return await new_msg.answer("❌ Пост уже опубликован или удалён.")
+    schedule.reschedule(post_id, new_dt.strftime(DATETIME_FORMAT))
+    await new_msg.answer("✅ Дата и время поста обновлены.")
     
-# ===== StubServer для Render (чтобы не падал из-за портов) =====
-import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
+@dp.message_handler(lambda msg: msg.text == "☠️ Неотправленные", state="*", user_id=ADMIN_ID)
+async def show_dead_letters(message: types.Message, state: FSMContext):
+    await state.finish()
+    if not publisher.current_dead_letters():
+        return await message.answer("✅ Все посты доставлены.")
+    text, keyboard = dead_letters_page(0)
+    await message.answer(text, reply_markup=keyboard)
+
+@dp.callback_query_handler(lambda c: c.data.startswith("dead:"), state="*", user_id=ADMIN_ID)
+async def dead_letters_page_callback(callback: types.CallbackQuery):
+    text, keyboard = dead_letters_page(int(callback.data.split(":")[1]))
+    await show_page(callback, text, keyboard)
+    await callback.answer()
+
+@dp.callback_query_handler(lambda c: c.data in ["dead_retry", "dead_clear"], state="*")
+async def handle_dead_letters_callback(callback: types.CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        return await callback.answer("⛔ Нет доступа", show_alert=True)
 
-class StubServer(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b"Bot is alive!")
+    if callback.data == "dead_retry":
+        count = publisher.retry_dead_letters()
+        await callback.message.answer(f"🔁 Повторная отправка: {count}")
+    elif callback.data == "dead_clear":
+        publisher.clear_dead_letters()
+        await callback.message.answer("🧹 Список очищен.")
+    await callback.message.delete()
+
+# === 📥 Импорт и 📤 экспорт ===
+@dp.message_handler(lambda msg: msg.text == "📥 Импорт", state="*", user_id=ADMIN_ID)
+async def import_prompt(message: types.Message, state: FSMContext):
+    await state.finish()
+    await ImportPosts.file.set()
+    await message.answer(
+        "Пришлите файл .jsonl или .csv (до 20 МБ).\n\n"
+        "JSONL — по объекту на строку: `{\"text\": \"...\"}` добавит пост в библиотеку, "
+        "`{\"datetime\": \"2025-04-15 18:30\", \"text\": \"...\"}` — в расписание. "
+        "Для фото — `file_id` или `url` и `caption`, для альбома — `media`.\n"
+        "CSV — те же поля колонками, как в файле экспорта.",
+        parse_mode=ParseMode.MARKDOWN
+    )
 
-def run_stub_server():
-    server = HTTPServer(("0.0.0.0", 10000), StubServer)
-    server.serve_forever()
+@dp.message_handler(state=ImportPosts.file, content_types=ContentType.DOCUMENT)
+async def receive_import_file(msg: types.Message, state: FSMContext):
+    await state.finish()
+    await msg.answer("⏳ Импортирую…")
+    fd, path = tempfile.mkstemp(suffix=".import")
+    os.close(fd)
+    importer = BulkImport()
+    try:
+        await msg.document.download(destination_file=path)
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            for _ in importer.batches(f, import_format(msg.document.file_name or "")):
+                await asyncio.sleep(0)
+    except (TelegramAPIError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        importer.failure = f"не удалось скачать файл ({e})"
+    finally:
+        os.remove(path)
+    logging.info(f"[IMPORT] библиотека {importer.library}, расписание {importer.scheduled}, "
+                 f"ошибок {importer.error_count}, прерван: {importer.failure or 'нет'}")
+    await msg.answer(importer.summary())
+    if importer.error_count > 20:
+        report = InputFile(io.BytesIO(importer.error_report().encode("utf-8")), filename="import_errors.txt")
+        await msg.answer_document(report, caption="Все ошибки импорта")
+
+@dp.message_handler(not_menu_button, state=ImportPosts.file, content_types=ContentType.ANY)
+async def receive_import_other(msg: types.Message):
+    await msg.answer("Пришлите файл .jsonl или .csv документом или нажмите /cancel.")
+
+@dp.message_handler(lambda msg: msg.text == "📤 Экспорт", state="*", user_id=ADMIN_ID)
+async def export_prompt(message: types.Message, state: FSMContext):
+    await state.finish()
+    keyboard = InlineKeyboardMarkup()
+    keyboard.add(
+        InlineKeyboardButton("JSONL", callback_data="export:jsonl"),
+        InlineKeyboardButton("CSV", callback_data="export:csv")
+    )
+    await message.answer("📤 В каком формате выгрузить посты?", reply_markup=keyboard)
 
-threading.Thread(target=run_stub_server, daemon=True).start()
+@dp.callback_query_handler(lambda c: c.data.startswith("export:"), state="*", user_id=ADMIN_ID)
+async def export_callback(callback: types.CallbackQuery):
+    fmt = callback.data.split(":")[1]
+    fd, path = tempfile.mkstemp(suffix="." + fmt)
+    os.close(fd)
+    try:
+        # Не в storage_executor: большая выгрузка задержала бы запись журнала
+        await asyncio.get_running_loop().run_in_executor(None, write_export, path, fmt, export_scheduled())
+        filename = f"vibey-posts-{datetime.now():%Y-%m-%d}.{fmt}"
+        await callback.message.answer_document(InputFile(path, filename=filename),
+                                               caption=f"📋 В библиотеке {post_store.count()}, 📅 в расписании {len(schedule.posts)}")
+    finally:
+        os.remove(path)
+    await callback.answer()
+    await callback.message.delete()
+
+# === 🔍 Поиск ===
+@dp.message_handler(lambda msg: msg.text == "🔍 Поиск", state="*", user_id=ADMIN_ID)
+async def search_prompt(message: types.Message, state: FSMContext):
+    await state.finish()
+    await SearchPosts.query.set()
+    await message.answer("🔍 Что найти? Слова из текста или подписи, дата вроде 15.04 или 2025-04-15.")
+
+@dp.message_handler(not_menu_button, state=SearchPosts.query)
+async def receive_search_query(msg: types.Message, state: FSMContext):
+    await state.finish()
+    await show_search(msg, state, (msg.text or "").strip())
+
+async def show_search(message: types.Message, state: FSMContext, query):
+    if search_query(query) is None:
+        return await message.answer("⚠️ В запросе нет слов для поиска.")
+    # Запрос — в данных FSM: следующую страницу может листать другая копия бота
+    await state.update_data(search=query)
+    text, keyboard = search_page(query, 0)
+    await message.answer(text, reply_markup=keyboard)
+
+@dp.callback_query_handler(lambda c: c.data.startswith("find:"), state="*", user_id=ADMIN_ID)
+async def search_page_callback(callback: types.CallbackQuery, state: FSMContext):
+    query = (await state.get_data()).get("search")
+    if query is None:
+        return await callback.answer("Поиск устарел — повторите запрос.", show_alert=True)
+    text, keyboard = search_page(query, int(callback.data.split(":")[1]))
+    await show_page(callback, text, keyboard)
+    await callback.answer()
+
+# ===== HTTP-сервер: вебхук, проверка здоровья, админка =====
+# Один aiohttp-сервер на порту 10000 (его проверяет хостинг). С WEBHOOK_HOST
+# бот получает обновления вебхуком, без него — long polling, а сервер
+# поднимается рядом в том же event loop.
+PORT = int(os.getenv("PORT", 10000))
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST")  # например https://vibeytravelers.onrender.com
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256((API_TOKEN or "").encode()).hexdigest()[:32]
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN")  # без него админские эндпоинты выключены
+HEALTH_MAX_TICK_AGE = SCHEDULER_TICK_SECONDS * 6
+HEALTH_MAX_LOOP_LAG = 1.0
+
+health = {"last_tick": None, "loop_lag": 0.0}
+loop_lag_task = None
+
+async def monitor_loop_lag():
+    # Насколько позже запланированного просыпается sleep — задержка event loop
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(1)
+        health["loop_lag"] = loop.time() - started - 1
+        LOOP_LAG.observe(max(0, health["loop_lag"]))
+
+async def health_handler(request):
+    tick_age = time.time() - health["last_tick"] if health["last_tick"] else None
+    alive = tick_age is not None and tick_age < HEALTH_MAX_TICK_AGE and health["loop_lag"] < HEALTH_MAX_LOOP_LAG
+    return web.json_response({
+        "status": "ok" if alive else "degraded",
+        "mode": "webhook" if WEBHOOK_HOST else "polling",
+        "role": "leader" if publisher.active else "follower",
+        "last_tick_age": tick_age,
+        "loop_lag": health["loop_lag"],
+        "scheduled": len(schedule.posts),
+        "publish_queue": publisher.queued(),
+        "dead_letters": len(publisher.dead_letters)
+    }, status=200 if alive else 503)
+
+@web.middleware
+async def check_access(request, handler):
+    if request.path == WEBHOOK_PATH:
+        if not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET):
+            raise web.HTTPForbidden()
+    elif request.path.startswith("/admin/"):
+        if not ADMIN_API_TOKEN:
+            raise web.HTTPNotFound()
+        if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {ADMIN_API_TOKEN}"):
+            raise web.HTTPUnauthorized()
+    return await handler(request)
+
+async def admin_schedule(request):
+    page = int(request.query.get("page", 0))
+    return web.json_response([
+        {"number": n, "id": post_id, "datetime": schedule.get(post_id)["datetime"], "type": schedule.get(post_id)["type"],
+         "targets": post_targets(schedule.get(post_id)), "preview": line}
+        for n, post_id, line in schedule_previews.page(page)
+    ])
+
+async def admin_search(request):
+    page = int(request.query.get("page", 0))
+    hits = find_posts(request.query.get("q", ""), (page + 1) * PAGE_SIZE)
+    return web.json_response(hits[page * PAGE_SIZE:])
+
+async def admin_dead_letters(request):
+    return web.json_response(publisher.current_dead_letters())
+
+async def admin_retry_dead_letters(request):
+    return web.json_response({"retried": publisher.retry_dead_letters()})
+
+def count_temp_files():
+    try:
+        return sum(1 for _ in os.scandir(IMAGE_DIR))
+    except FileNotFoundError:
+        return 0
+
+Gauge("scheduled_posts", "Постов в расписании").set_function(lambda: len(schedule.posts))
+Gauge("pending_previews", "Предпросмотров, ждущих подтверждения").set_function(fsm_storage.preview_count)
+Gauge("temp_files", "Файлов во временной папке изображений").set_function(count_temp_files)
+Gauge("outbox_posts", "Постов, ждущих подтверждения отправки").set_function(lambda: len(schedule.outbox))
+Gauge("publish_queue_size", "Постов в очереди на отправку").set_function(lambda: publisher.queued())
+Gauge("dead_letters", "Неотправленных постов").set_function(lambda: len(publisher.dead_letters))
+
+async def metrics_handler(request):
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+web_app = web.Application(middlewares=[check_access])
+web_app.router.add_get("/", health_handler)
+web_app.router.add_get("/health", health_handler)
+web_app.router.add_get("/metrics", metrics_handler)
+web_app.router.add_get("/admin/schedule", admin_schedule)
+web_app.router.add_get("/admin/search", admin_search)
+web_app.router.add_get("/admin/dead-letters", admin_dead_letters)
+web_app.router.add_post("/admin/dead-letters/retry", admin_retry_dead_letters)
+web_runner = None  # только в режиме polling
+
+async def start_web_server():
+    global web_runner
+    web_runner = web.AppRunner(web_app)
+    await web_runner.setup()
+    await web.TCPSite(web_runner, "0.0.0.0", PORT).start()
 
 # ===== Запуск планировщика при старте =====
 async def on_startup(_):
-    scheduler.add_job(check_scheduled_posts, "interval", minutes=1)
+    global loop_lag_task, lease_task
+    post_store.open()
+    post_store.migrate_from_txt(POSTS_FILE)
+    leader_lease.open()
+    fsm_storage.open()
+    media_groups.open()
+    schedule.load()
+    publisher.load()
+    media_cache.load()
+    cleanup_temp_images()
+    scheduler.add_job(sync_replicas, "interval", seconds=REPLICA_SYNC_SECONDS, max_instances=1, coalesce=True)
+    scheduler.add_job(cleanup_temp_images, "interval", hours=1)
+    scheduler.add_job(expire_idle_states, "interval", minutes=1)
     scheduler.start()
+    # Публикацию и тик расписания запускает become_leader, когда копия получит аренду
+    lease_task = asyncio.create_task(hold_lease())
+    loop_lag_task = asyncio.create_task(monitor_loop_lag())
+    if WEBHOOK_HOST:
+        await bot.set_webhook(WEBHOOK_HOST + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    else:
+        await bot.delete_webhook()
+        await start_web_server()
+
+async def on_shutdown(_):
+    lease_task.cancel()
+    await publisher.stop()
+    # Отложенные записи — на диск до выхода
+    await schedule.flush()
+    await publisher.dead_letters_file.flush()
+    await media_cache.file.flush()
+    # Аренду отпускаем последней: следующая ведущая прочитает всё записанное
+    await run_io("lease", leader_lease.release)
+    await close_http_session()
+    if web_runner is not None:
+        await web_runner.cleanup()
+
+def run_cli(argv):
+    # python bot.py import posts.jsonl | python bot.py export posts.csv
+    # Бот можно не останавливать: записи импорта он подхватит из общего
+    # журнала так же, как изменения другой своей копии.
+    import argparse
+    parser = argparse.ArgumentParser(prog="bot.py", description="Массовый импорт и экспорт постов")
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=["jsonl", "csv"], help="по умолчанию — по расширению файла")
+    args = parser.parse_args(argv)
+    fmt = args.format or import_format(args.path)
+
+    post_store.open()
+    post_store.migrate_from_txt(POSTS_FILE)
+    schedule.load()
+    if args.command == "export":
+        write_export(args.path, fmt, export_scheduled())
+        print(f"Выгружено: библиотека {post_store.count()}, расписание {len(schedule.posts)} → {args.path}")
+        return 0
+
+    importer = BulkImport()
+    with open(args.path, "r", encoding="utf-8-sig", newline="") as f:
+        for _ in importer.batches(f, fmt):
+            pass
+    for line_no, error in importer.errors:
+        print(f"{args.path}:{line_no}: {error}", file=sys.stderr)
+    if importer.failure:
+        print(f"{args.path}: импорт прерван: {importer.failure}", file=sys.stderr)
+    print(f"Импортировано: библиотека {importer.library}, расписание {importer.scheduled}, ошибок {importer.error_count}")
+    return 1 if importer.error_count or importer.failure else 0
 
 # ===== Запуск бота =====
 if __name__ == "__main__":
-    executor.start_polling(dp, on_startup=on_startup)
+    if len(sys.argv) > 1 and sys.argv[1] in ("import", "export"):
+        sys.exit(run_cli(sys.argv[1:]))
+    if WEBHOOK_HOST:
+        executor.set_webhook(dp, WEBHOOK_PATH, on_startup=on_startup, on_shutdown=on_shutdown, web_app=web_app).run_app(host="0.0.0.0", port=PORT)
+    else:
+        executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown)
@@ -0,0 +1,87 @@
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot
+
+
+@pytest.fixture
+def store(tmp_path):
+    def make():
+        return bot.ScheduledPosts(str(tmp_path / "scheduled_posts.json"),
+                                  str(tmp_path / "scheduled_posts.journal"),
+                                  str(tmp_path / "scheduled_posts.lock"))
+    return make
+
+
+def test_torn_journal_tail_does_not_swallow_next_record(store, tmp_path):
+    (tmp_path / "scheduled_posts.json").write_text("[]", encoding="utf-8")
+    (tmp_path / "scheduled_posts.journal").write_text('{"op":"put","post":{"id"', encoding="utf-8")
+
+    schedule = store()
+    schedule.load()
+    post = schedule.add({"datetime": "2030-01-01 12:00", "text": "после падения"})
+
+    reloaded = store()
+    reloaded.load()
+    assert reloaded.get(post["id"])["text"] == "после падения"
+
+
+def test_enqueue_adds_new_targets_to_post_in_outbox(store):
+    schedule = store()
+    schedule.load()
+    post = schedule.enqueue({"text": "новость"}, targets=["@a"])
+    schedule.enqueue(dict(post), targets=["@b"])
+
+    schedule.record_result(post["id"], "@a", "sent")
+    assert post["id"] in schedule.outbox
+    schedule.record_result(post["id"], "@b", "sent")
+    assert schedule.is_sent(post["id"], "@b")
+    assert post["id"] not in schedule.outbox
+
+
+def test_sync_after_snapshot_replaced_returns_new_outbox_posts(store, tmp_path):
+    schedule = store()
+    schedule.load()
+    # Другая копия успела отправить пост в outbox и свернуть журнал в снимок
+    sending = {"id": "news", "text": "новость", "status": "sending", "targets": ["@a"], "results": {}, "in_flight": []}
+    bot.write_file_atomic(str(tmp_path / "scheduled_posts.json"), json.dumps([sending]).encode("utf-8"))
+
+    records = asyncio.run(schedule.sync())
+    assert [(r["op"], r["post"]["id"]) for r in records] == [("send", "news")]
+    assert "news" in schedule.outbox
+
+
+def test_reimported_id_of_published_post_survives_reload(store):
+    schedule = store()
+    schedule.load()
+    post = schedule.add({"id": "paris", "datetime": "2030-01-01 12:00", "text": "Париж", "targets": ["@a"]})
+    schedule.pop_due("2030-01-01 12:00")
+    schedule.record_result(post["id"], "@a", "sent")
+    assert "paris" in schedule.finished
+
+    schedule.add_many([{"id": "paris", "datetime": "2031-01-01 12:00", "text": "Париж снова"}])
+
+    reloaded = store()
+    reloaded.load()
+    assert reloaded.get("paris")["datetime"] == "2031-01-01 12:00"
+    assert not reloaded.is_sent("paris", "@a")
+
+
+def test_legacy_album_caption_stays_plain_text(store, tmp_path):
+    # Альбом из версии без разбора разметки: подпись уходила как есть
+    album = {"id": "old", "datetime": "2030-01-01 12:00", "type": "album",
+             "media": [{"type": "photo", "media": "f1", "caption": "file_name_v2 *звезда"}]}
+    (tmp_path / "scheduled_posts.json").write_text(json.dumps([album]), encoding="utf-8")
+
+    schedule = store()
+    schedule.load()
+    assert bot.rendered(schedule.get("old"))["captions"] == [
+        {"caption": "file_name_v2 *звезда", "caption_entities": []}
+    ]